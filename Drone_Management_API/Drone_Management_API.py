@@ -1,25 +1,170 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, make_response, send_file, Response, stream_with_context
+from flask.logging import default_handler
 from flask_restful import Resource, Api
+from flask_restful.representations.json import output_json as flask_restful_output_json
 from marshmallow import Schema, fields, validates, ValidationError
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, Select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import registry
-from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import BadRequest, MethodNotAllowed, NotFound
+from werkzeug.http import parse_accept_header, parse_etags
+from datetime import datetime, timedelta, timezone
+from array import array
+from collections import OrderedDict, deque
+import argparse
+import asyncio
+import atexit
+import bisect
+import click
+import concurrent.futures
+import contextlib
+import copy
+import contextvars
+import cProfile
+import hashlib
+import importlib.util
+import io
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import math
+from logging.handlers import QueueHandler, RotatingFileHandler
 import os
+import pstats
+import queue
+import random
+import re
+import signal
+import socket
+import tempfile
+import threading
+import time
+import uuid
 
 project_path = os.path.dirname(os.path.abspath(__file__))
 nombre_bd = 'sqlite.db'
 address = os.path.join(project_path, nombre_bd)
 
 
+# Connection profiles of SQLite. The production profile uses WAL so the readers do not wait for the writers,
+# waits busy_timeout ms for the write lock instead of failing with "database is locked" and keeps a pool of connections
+SQLITE_PROFILES = {
+    'default': {
+        'pragmas': {'foreign_keys': 'ON'},
+        'engine_options': {},
+    },
+    'production': {
+        'pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 268435456, 'cache_size': -65536,
+                    'busy_timeout': 5000, 'temp_store': 'MEMORY', 'foreign_keys': 'ON'},
+        'engine_options': {'pool_size': 16, 'max_overflow': 16, 'pool_timeout': 30,
+                           'connect_args': {'timeout': 5, 'check_same_thread': False}},
+    },
+}
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+
+    '''Set the pragmas on a new SQLite connection'''
+
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+def configure_sqlite_engine(engine, profile, read_only=False):
+
+    '''Set the pragmas of the profile on every connection opened by the engine. The journal mode is kept in the
+    database file, so the read-only connections leave it to the writer and only refuse the writes'''
+
+    pragmas = dict(SQLITE_PROFILES[profile]['pragmas'])
+    if read_only:
+        pragmas.pop('journal_mode', None)
+        pragmas['query_only'] = 'ON'
+    event.listen(engine, 'connect', lambda dbapi_connection, connection_record: set_sqlite_pragmas(dbapi_connection, pragmas))
+
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{address}'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DRONE_DATABASE_URI', f'sqlite:///{address}')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# SQLite profile, set DRONE_DB_PROFILE=production in the servers and DRONE_DB_READ_ONLY=1 to send the reads to read-only connections
+app.config['DRONE_DB_PROFILE'] = os.environ.get('DRONE_DB_PROFILE', 'default')
+app.config['DRONE_DB_READ_ONLY'] = os.environ.get('DRONE_DB_READ_ONLY') == '1'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLITE_PROFILES[app.config['DRONE_DB_PROFILE']]['engine_options']
+# Lookup cache, set DRONE_CACHE_REDIS_URL to share it between several worker processes
+app.config['DRONE_CACHE_SIZE'] = int(os.environ.get('DRONE_CACHE_SIZE', 4096))
+app.config['DRONE_CACHE_TTL'] = float(os.environ.get('DRONE_CACHE_TTL', 5.0))
+app.config['DRONE_CACHE_REDIS_URL'] = os.environ.get('DRONE_CACHE_REDIS_URL')
+# Telemetry buffer, flushed every interval seconds or when size drones are pending
+app.config['DRONE_TELEMETRY_FLUSH_INTERVAL'] = float(os.environ.get('DRONE_TELEMETRY_FLUSH_INTERVAL', 1.0))
+app.config['DRONE_TELEMETRY_FLUSH_SIZE'] = int(os.environ.get('DRONE_TELEMETRY_FLUSH_SIZE', 1000))
+app.config['DRONE_TELEMETRY_MAX_PENDING'] = int(os.environ.get('DRONE_TELEMETRY_MAX_PENDING', 100000))
+# JSON encoder of the responses, orjson when it is installed or json for the standard library
+app.config['DRONE_JSON_ENCODER'] = os.environ.get('DRONE_JSON_ENCODER', 'orjson')
+# Seconds the fleet index of the dispatch queries is used before it is reloaded, the writes of the process update it
+app.config['DRONE_FLEET_INDEX_TTL'] = float(os.environ.get('DRONE_FLEET_INDEX_TTL', 5.0))
+# Seconds a start_Drone_scheduler process holds the lease of the scheduled jobs without renewing it
+app.config['DRONE_SCHEDULER_LEASE'] = float(os.environ.get('DRONE_SCHEDULER_LEASE', 60))
+# Request metrics of /metrics, slow request threshold, fraction of the requests profiled and repeated statements of an N+1 query
+app.config['DRONE_METRICS'] = os.environ.get('DRONE_METRICS', '1') == '1'
+app.config['DRONE_SLOW_REQUEST_MS'] = float(os.environ.get('DRONE_SLOW_REQUEST_MS', 500))
+app.config['DRONE_PROFILE_RATE'] = float(os.environ.get('DRONE_PROFILE_RATE', 0.0))
+app.config['DRONE_REPEATED_STATEMENTS'] = int(os.environ.get('DRONE_REPEATED_STATEMENTS', 10))
+# Log file, json lines or text, rotated at max bytes or after rotate seconds keeping backup count files, and the
+# records queued for the writer thread before new ones are dropped
+app.config['DRONE_LOG_FILE'] = os.environ.get('DRONE_LOG_FILE', os.path.join(project_path, 'register.log'))
+app.config['DRONE_LOG_FORMAT'] = os.environ.get('DRONE_LOG_FORMAT', 'json')
+app.config['DRONE_LOG_MAX_BYTES'] = int(os.environ.get('DRONE_LOG_MAX_BYTES', 10 * 1024 * 1024))
+app.config['DRONE_LOG_ROTATE_SECONDS'] = float(os.environ.get('DRONE_LOG_ROTATE_SECONDS', 86400))
+app.config['DRONE_LOG_BACKUP_COUNT'] = int(os.environ.get('DRONE_LOG_BACKUP_COUNT', 5))
+app.config['DRONE_LOG_QUEUE_SIZE'] = int(os.environ.get('DRONE_LOG_QUEUE_SIZE', 10000))
+# Directory of the medication images, largest image accepted, sizes of the thumbnails in pixels and threads creating them
+app.config['DRONE_IMAGE_DIR'] = os.environ.get('DRONE_IMAGE_DIR', os.path.join(project_path, 'blobs'))
+app.config['DRONE_IMAGE_MAX_BYTES'] = int(os.environ.get('DRONE_IMAGE_MAX_BYTES', 5 * 1024 * 1024))
+app.config['DRONE_THUMBNAIL_SIZES'] = [int(size) for size in os.environ.get('DRONE_THUMBNAIL_SIZES', '128,512').split(',') if size]
+app.config['DRONE_THUMBNAIL_WORKERS'] = int(os.environ.get('DRONE_THUMBNAIL_WORKERS', 2))
+
+class RoutingSession(Session):
+
+    '''Session that sends the queries to the read-only engine when there is one, unless the session has written
+    in the current transaction. The writes and the reads that follow them use the default engine'''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if read_engine is not None and bind is None and isinstance(clause, Select) \
+                and not self._flushing and not self.info.get('wrote'):
+            return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def mark_write_statement(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['wrote'] = True
+
+@event.listens_for(RoutingSession, 'after_flush')
+def mark_flush(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def clear_write_mark(session):
+    session.info.pop('wrote', None)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 api = Api(app)
 
+read_engine = None
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        configure_sqlite_engine(db.engine, app.config['DRONE_DB_PROFILE'])
+        if app.config['DRONE_DB_READ_ONLY'] and db.engine.url.database:
+            # The first connection of the writer sets the journal mode before any reader opens the file
+            db.engine.connect().close()
+            read_engine = db.create_engine(f'sqlite:///file:{db.engine.url.database}?mode=ro&uri=true',
+                                           **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+            configure_sqlite_engine(read_engine, app.config['DRONE_DB_PROFILE'], read_only=True)
+
 #model
 
 class Drone(db.Model):
@@ -27,13 +172,21 @@ class Drone(db.Model):
     '''Model of Drone'''
     
     __tablename__ = 'drone'
+    # Partial covering index of the dispatch query, only the IDLE drones are indexed
+    __table_args__ = (db.Index('ix_drone_idle', 'id', 'serial_number', 'model', 'weight_limit', 'battery_capacity', 'state',
+                               'current_payload_weight', sqlite_where=db.text("state = 'IDLE'")),)
     id = db.Column(db.Integer, primary_key=True)
     serial_number = db.Column(db.String(100), unique=True, nullable=False)
     model = db.Column(db.String(20), nullable=False)
     weight_limit = db.Column(db.Float, nullable=False)
     battery_capacity = db.Column(db.Float, nullable=False)
     state = db.Column(db.String(20), nullable=False)
-    drone_medications = db.relationship('DroneMedication', back_populates='drone')
+    # Sum of the weight of the medications loaded on the drone, kept up to date by every write of DroneMedication
+    current_payload_weight = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    # Increased by every change of state, a transition can require the version the client read
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # The associations are deleted by the database, ON DELETE CASCADE
+    drone_medications = db.relationship('DroneMedication', back_populates='drone', passive_deletes=True)
 
 class Medication(db.Model):
 
@@ -45,52 +198,769 @@ class Medication(db.Model):
     weight = db.Column(db.Float, nullable=False)
     code = db.Column(db.String(20), unique=True, nullable=False)
     image = db.Column(db.String(100), nullable=False)
-    drone_medications = db.relationship('DroneMedication', back_populates='medication')
+    drone_medications = db.relationship('DroneMedication', back_populates='medication', passive_deletes=True)
 
 class DroneMedication(db.Model):
 
     '''Model of DroneMedication'''
     
     __tablename__ = 'drone_medication'
+    # The unique index also serves the lookups by drone_id
+    __table_args__ = (db.Index('ix_drone_medication_drone_id_medication_id', 'drone_id', 'medication_id', unique=True),
+                      db.Index('ix_drone_medication_medication_id', 'medication_id'))
     id = db.Column(db.Integer, primary_key=True)
-    drone_id = db.Column(db.Integer, db.ForeignKey('drone.id'), nullable=False)
-    medication_id = db.Column(db.Integer, db.ForeignKey('medication.id'), nullable=False)
+    drone_id = db.Column(db.Integer, db.ForeignKey('drone.id', ondelete='CASCADE'), nullable=False)
+    medication_id = db.Column(db.Integer, db.ForeignKey('medication.id', ondelete='CASCADE'), nullable=False)
     medication = db.relationship('Medication', back_populates='drone_medications')
     drone = db.relationship('Drone', back_populates='drone_medications')
 
+class BatteryAudit(db.Model):
+
+    '''Model of BatteryAudit, battery level of every drone at each run of the audit. The rows are stored
+    in (drone_id, ts) order so the history of a drone is read with a range scan of the primary key'''
+
+    __tablename__ = 'battery_audit'
+    __table_args__ = {'sqlite_with_rowid': False}
+    drone_id = db.Column(db.Integer, db.ForeignKey('drone.id', ondelete='CASCADE'), primary_key=True)
+    ts = db.Column(db.DateTime, primary_key=True)
+    battery_capacity = db.Column(db.Float, nullable=False)
+
+class BatteryRollup(db.Model):
+
+    '''Model of BatteryRollup, minimum, sum and maximum of the battery level of a drone per bucket of resolution seconds.
+    Every audit adds its snapshots to the current buckets so the long histories are read without scanning battery_audit'''
+
+    __tablename__ = 'battery_rollup'
+    __table_args__ = {'sqlite_with_rowid': False}
+    drone_id = db.Column(db.Integer, db.ForeignKey('drone.id', ondelete='CASCADE'), primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    samples = db.Column(db.Integer, nullable=False)
+    battery_sum = db.Column(db.Float, nullable=False)
+    battery_min = db.Column(db.Float, nullable=False)
+    battery_max = db.Column(db.Float, nullable=False)
+
+class SchedulerLease(db.Model):
+
+    '''Model of SchedulerLease, the process that holds the lease of a name runs its scheduled jobs until expires_at'''
+
+    __tablename__ = 'scheduler_lease'
+    name = db.Column(db.String(100), primary_key=True)
+    owner = db.Column(db.String(200), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class ChangeSequence(db.Model):
+
+    '''Model of ChangeSequence, counts the writes of every table. It is maintained by triggers and gives the ETag of the read endpoints'''
+
+    __tablename__ = 'change_sequence'
+    table_name = db.Column(db.String(50), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+
+# Columns of every table that change the responses of the read endpoints
+TRACKED_COLUMNS = {
+    'drone': ('serial_number', 'model', 'weight_limit', 'battery_capacity', 'state'),
+    'medication': ('name', 'weight', 'code', 'image'),
+    'drone_medication': ('drone_id', 'medication_id'),
+}
+
+def change_sequence_triggers():
+
+    '''SQL of the triggers that increase the change sequence of a table on every insert, update or delete'''
+
+    statements = [f"INSERT OR IGNORE INTO change_sequence (table_name, seq) VALUES ('{table}', 0)" for table in TRACKED_COLUMNS]
+    for table, columns in TRACKED_COLUMNS.items():
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            event_name = f'UPDATE OF {", ".join(columns)}' if operation == 'UPDATE' else operation
+            statements.append(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{operation.lower()}_seq AFTER {event_name} ON {table} "
+                              f"BEGIN UPDATE change_sequence SET seq = seq + 1 WHERE table_name = '{table}'; END")
+    return statements
+
+def payload_weight_update(medication_id, delta):
+
+    '''Update that adds delta to the payload weight of every drone loaded with the medication'''
+
+    loaded_drones = db.select(DroneMedication.drone_id).where(DroneMedication.medication_id == medication_id)
+    return db.update(Drone).where(Drone.id.in_(loaded_drones)) \
+        .values(current_payload_weight=Drone.current_payload_weight + delta) \
+        .execution_options(synchronize_session=False)
+
+def adjust_payload_weight(medication_id, delta):
+
+    '''Add delta to the payload weight of every drone loaded with the medication'''
+
+    db.session.execute(payload_weight_update(medication_id, delta))
+
+def reserve_payload_update(drone_id, added_weight):
+
+    '''Update that adds the weight to the payload of the drone, it only matches if the new payload is within the drone limit'''
+
+    return db.update(Drone) \
+        .where(Drone.id == drone_id, Drone.current_payload_weight + added_weight <= Drone.weight_limit) \
+        .values(current_payload_weight=Drone.current_payload_weight + added_weight) \
+        .execution_options(synchronize_session=False)
+
+def payload_weight_subquery():
+
+    '''Weight of the medications loaded on each drone computed from DroneMedication'''
+
+    return db.select(db.func.coalesce(db.func.sum(Medication.weight), 0.0)) \
+        .join(DroneMedication, Medication.id == DroneMedication.medication_id) \
+        .where(DroneMedication.drone_id == Drone.id).scalar_subquery()
+
+def verify_payload_weights():
+
+    '''Get the serial number, the stored and the real payload weight of the drones whose counter is wrong'''
+
+    real_weight = payload_weight_subquery()
+    return db.session.execute(db.select(Drone.serial_number, Drone.current_payload_weight, real_weight)
+                              .where(db.func.abs(Drone.current_payload_weight - real_weight) > 1e-6)).all()
+
+def recompute_payload_weights():
+
+    '''Recompute the payload weight of every drone with a single update'''
+
+    db.session.execute(db.update(Drone).values(current_payload_weight=payload_weight_subquery())
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+@app.cli.command('payload-weights')
+@click.option('--verify', is_flag=True, help='Only report the drones whose payload weight is wrong.')
+def payload_weights_command(verify):
+
+    '''Recompute the payload weight counter of the drones or verify it'''
+
+    wrong_weights = verify_payload_weights()
+    for serial_number, stored_weight, real_weight in wrong_weights:
+        click.echo(f'The Drone {serial_number} has {stored_weight} of payload weight instead of {real_weight}')
+    if verify:
+        if wrong_weights:
+            raise SystemExit(1)
+        click.echo('The payload weight of every drone is correct')
+    else:
+        recompute_payload_weights()
+        click.echo(f'Payload weight repaired on {len(wrong_weights)} drones')
+
+# Versioned schema migrations, the number of the last migration applied is kept in PRAGMA user_version.
+# Every step is idempotent because db.create_all() already builds the latest schema on a new database
+def create_index(table, name):
+
+    '''Migration step that creates an index declared in the models if it does not exist'''
+
+    def step(connection):
+        index = next(index for index in db.metadata.tables[table].indexes if index.name == name)
+        index.create(connection, checkfirst=True)
+    return step
+
+def add_column(table, name):
+
+    '''Migration step that adds a column declared in the models if it does not exist, the column must have a server default'''
+
+    def step(connection):
+        existing_columns = {column['name'] for column in db.inspect(connection).get_columns(table)}
+        if name not in existing_columns:
+            column = db.metadata.tables[table].columns[name]
+            column_type = column.type.compile(connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {column_type} "
+                                       f"NOT NULL DEFAULT {column.server_default.arg}")
+    return step
+
+def rebuild_table(table, condition):
+
+    '''Migration step that recreates a table from its model, for the constraints that SQLite can not alter.
+    The rows that match the condition are copied, the indexes are created again and the triggers must be'''
+
+    def step(connection):
+        connection.exec_driver_sql(f'ALTER TABLE {table} RENAME TO {table}_old')
+        for index in db.inspect(connection).get_indexes(f'{table}_old'):
+            connection.exec_driver_sql(f'DROP INDEX {index["name"]}')
+        db.metadata.tables[table].create(connection)
+        columns = ', '.join(column.name for column in db.metadata.tables[table].columns)
+        connection.exec_driver_sql(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_old WHERE {condition}')
+        connection.exec_driver_sql(f'DROP TABLE {table}_old')
+    return step
+
+MIGRATIONS = [
+    (1, 'Unique association between a drone and a medication', [
+        'DELETE FROM drone_medication WHERE id NOT IN '
+        '(SELECT min(id) FROM drone_medication GROUP BY drone_id, medication_id)',
+        create_index('drone_medication', 'ix_drone_medication_drone_id_medication_id'),
+    ]),
+    (2, 'Payload weight counter of the drones', [
+        add_column('drone', 'current_payload_weight'),
+        'UPDATE drone SET current_payload_weight = (SELECT coalesce(sum(medication.weight), 0) FROM drone_medication '
+        'JOIN medication ON medication.id = drone_medication.medication_id WHERE drone_medication.drone_id = drone.id)',
+    ]),
+    (3, 'Indexes of the dispatch query and of the medication associations', [
+        create_index('drone', 'ix_drone_idle'),
+        create_index('drone_medication', 'ix_drone_medication_medication_id'),
+    ]),
+    (4, 'Change sequence of the tables for the ETags', change_sequence_triggers()),
+    (5, 'Battery rollups of the audits saved before', [
+        "INSERT INTO battery_rollup (drone_id, resolution, bucket, samples, battery_sum, battery_min, battery_max) "
+        "SELECT drone_id, 3600, strftime('%Y-%m-%d %H:00:00.000000', ts), count(*), sum(battery_capacity), "
+        "min(battery_capacity), max(battery_capacity) FROM battery_audit GROUP BY 1, 3 ON CONFLICT DO NOTHING",
+        "INSERT INTO battery_rollup (drone_id, resolution, bucket, samples, battery_sum, battery_min, battery_max) "
+        "SELECT drone_id, 86400, strftime('%Y-%m-%d 00:00:00.000000', ts), count(*), sum(battery_capacity), "
+        "min(battery_capacity), max(battery_capacity) FROM battery_audit GROUP BY 1, 3 ON CONFLICT DO NOTHING",
+    ]),
+    (6, 'Version of the state of the drones', [
+        add_column('drone', 'version'),
+    ]),
+    (7, 'ON DELETE CASCADE foreign keys of the associations and of the battery history', [
+        rebuild_table('drone_medication', 'drone_id IN (SELECT id FROM drone) AND medication_id IN (SELECT id FROM medication)'),
+        rebuild_table('battery_audit', 'drone_id IN (SELECT id FROM drone)'),
+        rebuild_table('battery_rollup', 'drone_id IN (SELECT id FROM drone)'),
+    ] + change_sequence_triggers()),
+]
+
+def upgrade_database():
+
+    '''Create the missing tables and apply the migrations that the database does not have yet'''
+
+    db.create_all()
+    with db.engine.begin() as connection:
+        version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for number, description, steps in MIGRATIONS:
+            if number <= version:
+                continue
+            app.logger.info(f'Applying migration {number}: {description}')
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.exec_driver_sql(step)
+            connection.exec_driver_sql(f'PRAGMA user_version = {number}')
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+
+    '''Create the tables and apply the pending schema migrations'''
+
+    upgrade_database()
+    click.echo('The database is up to date')
+
 # Registration system configuration
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-log_handler = RotatingFileHandler(os.path.join(project_path, 'register.log'), maxBytes=10000, backupCount=1)
-log_handler.setFormatter(log_formatter)
-log_handler.setLevel(logging.INFO)
+# Logging pipeline. The threads that log put the records in a bounded queue without waiting, a full queue drops the
+# record and counts it. A single writer thread writes the records to the log file in batches
+class JsonLogFormatter(logging.Formatter):
+
+    '''One JSON object per line with the time, level, logger, thread and message of the record, and its traceback'''
+
+    def format(self, record):
+        entry = {'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'logger': record.name, 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+class BatchFileHandler(RotatingFileHandler):
+
+    '''Rotating file handler that writes a batch of records with one write. The file is rotated when the batch would
+    make it larger than maxBytes or when it is older than rotate_seconds, backupCount old files are kept'''
 
-# Flask application logger configuration
-app.logger.addHandler(log_handler)
+    def __init__(self, filename, maxBytes=0, backupCount=0, rotate_seconds=0):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.opened_at = time.time()
+
+    def emit_batch(self, records):
+
+        '''Write the records, returns False if the write failed'''
+
+        try:
+            text = ''.join(self.format(record) + self.terminator for record in records)
+            if self.stream is None:
+                self.stream = self._open()
+            size = self.stream.tell()
+            if size and ((self.maxBytes and size + len(text) > self.maxBytes) or
+                         (self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds)):
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(text)
+            self.stream.flush()
+            return True
+        except Exception:
+            self.handleError(records[-1])
+            return False
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+class LogPipeline(QueueHandler):
+
+    '''Queue handler of the logger. The record is prepared in the thread that logs it, with its message and traceback
+    formatted, and queued without blocking. The writer thread takes up to batch_size records at a time and writes them
+    with the file handler, then logs how many records were dropped since its last report'''
+
+    traceback_formatter = logging.Formatter()
+
+    def __init__(self, file_handler, queue_size=10000, batch_size=500):
+        super().__init__(None)
+        self.file_handler = file_handler
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.write_errors = 0
+        self._reported_dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._writer = None
+        self.queue = queue.Queue(queue_size)
+
+    def start(self):
+
+        '''Start the writer thread'''
+
+        self._writer = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._writer.start()
+
+    def restart_after_fork(self):
+
+        '''A forked process has no writer thread and the queue may be locked by it, start a new one with a new queue'''
+
+        self.queue = queue.Queue(self.queue_size)
+        self.start()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = self.traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _run(self):
+        pending = self.queue
+        while True:
+            taken = [pending.get()]
+            while len(taken) < self.batch_size:
+                try:
+                    taken.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in taken if record is not None]
+            dropped = self.dropped - self._reported_dropped
+            if dropped:
+                self._reported_dropped += dropped
+                records.append(app.logger.makeRecord(app.logger.name, logging.WARNING, __file__, 0,
+                                                     f'{dropped} log records were dropped, the log queue was full', None, None))
+            if records:
+                if self.file_handler.emit_batch(records):
+                    self.written += len(records)
+                    self.batches += 1
+                else:
+                    self.write_errors += 1
+            for _ in taken:
+                pending.task_done()
+            if None in taken:
+                return
+
+    def flush(self):
+
+        '''Wait until the queued records are written'''
+
+        if self._writer is not None and self._writer.is_alive():
+            self.queue.join()
+
+    def stop(self):
+
+        '''Write the queued records and stop the writer thread'''
+
+        if self._writer is not None and self._writer.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                return
+            self._writer.join(timeout=5)
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'batches': self.batches,
+                'write_errors': self.write_errors, 'queued': self.queue.qsize()}
+
+    def render(self):
+
+        '''Counters of the pipeline in the Prometheus text format'''
+
+        stats = self.stats()
+        return (f'# TYPE drone_log_records_total counter\n'
+                f'drone_log_records_total{{outcome="written"}} {stats["written"]}\n'
+                f'drone_log_records_total{{outcome="dropped"}} {stats["dropped"]}\n'
+                f'# TYPE drone_log_write_errors_total counter\n'
+                f'drone_log_write_errors_total {stats["write_errors"]}\n'
+                f'# TYPE drone_log_queued_records gauge\n'
+                f'drone_log_queued_records {stats["queued"]}\n')
+
+log_file_handler = BatchFileHandler(app.config['DRONE_LOG_FILE'], maxBytes=app.config['DRONE_LOG_MAX_BYTES'],
+                                    backupCount=app.config['DRONE_LOG_BACKUP_COUNT'],
+                                    rotate_seconds=app.config['DRONE_LOG_ROTATE_SECONDS'])
+if app.config['DRONE_LOG_FORMAT'] == 'json':
+    log_file_handler.setFormatter(JsonLogFormatter())
+else:
+    log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_pipeline = LogPipeline(log_file_handler, queue_size=app.config['DRONE_LOG_QUEUE_SIZE'])
+log_pipeline.setLevel(logging.INFO)
+log_pipeline.start()
+os.register_at_fork(after_in_child=log_pipeline.restart_after_fork)
+atexit.register(log_pipeline.stop)
+
+# Flask application logger configuration, the pipeline replaces the stderr handler of Flask so the requests never write
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(log_pipeline)
 app.logger.setLevel(logging.INFO)
 
 
+# Request metrics exposed at /metrics in the Prometheus text format: latency of every route, SQL statements and SQL time
+# of every request from the engine events, serialization time, and the slow requests and repeated statements found
+# Upper bounds of the buckets of the histograms, in seconds and in statements
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+# Length of the statements written to the log
+LOGGED_STATEMENT_LENGTH = 300
+
+class Histogram:
+
+    '''Counts of the observed values per bucket, with their sum and count'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class RequestStats:
+
+    '''Measures of a request, the engine events and the serialization add to them while the request runs'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.statements = {}
+        self.status = 500
+        self.profiler = None
+
+# Measures of the request running in the current thread, None outside of the requests
+current_request_stats = contextvars.ContextVar('current_request_stats', default=None)
+
+def prometheus_labels(labels):
+    return ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                    for name, value in labels)
+
+class RequestMetrics:
+
+    '''Metrics of the requests of the process. A request slower than slow_request_seconds is counted and logged, with its
+    cProfile statistics when it was sampled for profiling (profile_rate of the requests, one at a time). A statement run
+    repeated_statements times or more by a request is counted and logged once per route as a probable N+1 query'''
+
+    def __init__(self, slow_request_seconds=0.5, profile_rate=0.0, repeated_statements=10, slow_samples=20):
+        self.slow_request_seconds = slow_request_seconds
+        self.profile_rate = profile_rate
+        self.repeated_statements = repeated_statements
+        self.slow_requests = deque(maxlen=slow_samples)
+        self._histograms = {'drone_http_request_duration_seconds': {}, 'drone_sql_statements_per_request': {},
+                            'drone_sql_duration_seconds': {}, 'drone_serialization_duration_seconds': {}}
+        self._counters = {'drone_http_requests_total': {}, 'drone_slow_requests_total': {}, 'drone_repeated_statements_total': {}}
+        self._reported_statements = set()
+        self._lock = threading.Lock()
+        self._profiler_lock = threading.Lock()
+
+    def start(self):
+
+        '''Measures of a new request, profiled if it is sampled and no other request is being profiled'''
+
+        stats = RequestStats()
+        if self.profile_rate and random.random() < self.profile_rate and self._profiler_lock.acquire(blocking=False):
+            stats.profiler = cProfile.Profile()
+            stats.profiler.enable()
+        return stats
+
+    def finish(self, stats, route, method):
+
+        '''Add the measures of a finished request to the metrics'''
+
+        elapsed = time.perf_counter() - stats.started
+        if stats.profiler is not None:
+            stats.profiler.disable()
+            self._profiler_lock.release()
+        labels = (('route', route), ('method', method))
+        repeated = [(statement, count) for statement, count in stats.statements.items() if count >= self.repeated_statements]
+        with self._lock:
+            self._observe('drone_http_request_duration_seconds', labels, elapsed, LATENCY_BUCKETS)
+            self._observe('drone_sql_statements_per_request', labels, stats.sql_statements, STATEMENT_BUCKETS)
+            self._observe('drone_sql_duration_seconds', labels, stats.sql_seconds, LATENCY_BUCKETS)
+            self._observe('drone_serialization_duration_seconds', labels, stats.serialization_seconds, LATENCY_BUCKETS)
+            self._increment('drone_http_requests_total', labels + (('status', stats.status),))
+            if repeated:
+                self._increment('drone_repeated_statements_total', labels)
+                new_statements = [(statement, count) for statement, count in repeated
+                                  if (route, method, statement) not in self._reported_statements]
+                self._reported_statements.update((route, method, statement) for statement, count in new_statements)
+            if elapsed >= self.slow_request_seconds:
+                self._increment('drone_slow_requests_total', labels)
+
+        if repeated:
+            for statement, count in new_statements:
+                app.logger.warning(f'Possible N+1 query: {method} {route} ran {count} times '
+                                   f'{statement[:LOGGED_STATEMENT_LENGTH]}')
+        if elapsed >= self.slow_request_seconds:
+            sample = {'route': route, 'method': method, 'seconds': elapsed, 'sql_statements': stats.sql_statements,
+                      'sql_seconds': stats.sql_seconds, 'serialization_seconds': stats.serialization_seconds, 'profile': None}
+            if stats.profiler is not None:
+                output = io.StringIO()
+                pstats.Stats(stats.profiler, stream=output).sort_stats('cumulative').print_stats(20)
+                sample['profile'] = output.getvalue()
+            self.slow_requests.append(sample)
+            app.logger.warning(f'Slow request: {method} {route} took {elapsed * 1000:.1f} ms, {stats.sql_statements} '
+                               f'SQL statements in {stats.sql_seconds * 1000:.1f} ms' +
+                               (f'\n{sample["profile"]}' if sample['profile'] else ''))
+
+    def _observe(self, name, labels, value, buckets):
+        histogram = self._histograms[name].get(labels)
+        if histogram is None:
+            histogram = self._histograms[name][labels] = Histogram(buckets)
+        histogram.observe(value)
+
+    def _increment(self, name, labels):
+        self._counters[name][labels] = self._counters[name].get(labels, 0) + 1
+
+    def render(self):
+
+        '''The metrics in the Prometheus text format'''
+
+        lines = []
+        with self._lock:
+            for name, series in self._histograms.items():
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{prometheus_labels(labels + (("le", bound),))}}} {cumulative}')
+                    lines.append(f'{name}_sum{{{prometheus_labels(labels)}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{prometheus_labels(labels)}}} {histogram.count}')
+            for name, series in self._counters.items():
+                lines.append(f'# TYPE {name} counter')
+                for labels, count in sorted(series.items()):
+                    lines.append(f'{name}{{{prometheus_labels(labels)}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            for series in list(self._histograms.values()) + list(self._counters.values()):
+                series.clear()
+            self._reported_statements.clear()
+            self.slow_requests.clear()
+
+request_metrics = RequestMetrics(slow_request_seconds=app.config['DRONE_SLOW_REQUEST_MS'] / 1000,
+                                 profile_rate=app.config['DRONE_PROFILE_RATE'],
+                                 repeated_statements=app.config['DRONE_REPEATED_STATEMENTS'])
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if current_request_stats.get() is not None:
+        connection.info['statement_started'] = time.perf_counter()
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    stats = current_request_stats.get()
+    started = connection.info.pop('statement_started', None)
+    if stats is not None and started is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += time.perf_counter() - started
+        stats.statements[statement] = stats.statements.get(statement, 0) + 1
+
+def instrument_engine(engine):
+
+    '''Add the statements of the engine and their time to the measures of the request running them'''
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+with app.app_context():
+    instrument_engine(db.engine)
+if read_engine is not None:
+    instrument_engine(read_engine)
+
+def record_serialization(started):
+
+    '''Add the time since started to the serialization time of the current request'''
+
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.serialization_seconds += time.perf_counter() - started
+
+@app.before_request
+def start_request_metrics():
+    if app.config['DRONE_METRICS']:
+        current_request_stats.set(request_metrics.start())
+
+@app.after_request
+def set_request_status(response):
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    stats = current_request_stats.get()
+    if stats is not None:
+        current_request_stats.set(None)
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_metrics.finish(stats, route, request.method)
+
+
+# Seconds between two runs of the battery audit
+AUDIT_INTERVAL_SECONDS = 300
+# Resolutions of the battery rollups in seconds
+ROLLUP_RESOLUTIONS = {'1h': 3600, '1d': 86400}
+EPOCH = datetime(1970, 1, 1)
+
+def bucket_start(ts, resolution):
+
+    '''Start of the rollup bucket of resolution seconds that contains ts'''
+
+    elapsed = (ts - EPOCH) // timedelta(seconds=resolution)
+    return EPOCH + timedelta(seconds=elapsed * resolution)
+
+def save_battery_snapshots(ts):
+
+    '''Save the battery level of all the drones at ts with a single insert and add it to the current bucket of every rollup'''
+
+    drones = db.session.execute(db.select(Drone.id, Drone.battery_capacity)).all()
+    if not drones:
+        return 0
+
+    db.session.execute(db.insert(BatteryAudit),
+                       [{'drone_id': drone_id, 'ts': ts, 'battery_capacity': battery_capacity}
+                        for drone_id, battery_capacity in drones])
+
+    # The rollups are updated incrementally from the new snapshots only
+    rollup = BatteryRollup.__table__
+    statement = sqlite_insert(rollup)
+    statement = statement.on_conflict_do_update(
+        index_elements=[rollup.c.drone_id, rollup.c.resolution, rollup.c.bucket],
+        set_={'samples': rollup.c.samples + statement.excluded.samples,
+              'battery_sum': rollup.c.battery_sum + statement.excluded.battery_sum,
+              'battery_min': db.func.min(rollup.c.battery_min, statement.excluded.battery_min),
+              'battery_max': db.func.max(rollup.c.battery_max, statement.excluded.battery_max)})
+    for resolution in ROLLUP_RESOLUTIONS.values():
+        bucket = bucket_start(ts, resolution)
+        db.session.execute(statement, [{'drone_id': drone_id, 'resolution': resolution, 'bucket': bucket, 'samples': 1,
+                                        'battery_sum': battery_capacity, 'battery_min': battery_capacity,
+                                        'battery_max': battery_capacity}
+                                       for drone_id, battery_capacity in drones])
+    db.session.commit()
+    return len(drones)
+
 # Method to be executed periodically
 def check_battery_levels_and_create_audit_log():
 
     '''Method that will be executed periodically to register the drone battery'''
     
-    audit_log = []
     with app.app_context():
-        app.logger.info("Audit Log:")
-        
-        # Verificar si existen drones en la base de datos
-        drones = Drone.query.all()
-
-        if not drones:
-            app.logger.info("No drones found in the database.")
+        saved = save_battery_snapshots(datetime.utcnow())
+        if saved:
+            app.logger.info(f'Audit Log: battery level of {saved} drones saved')
         else:
-            for drone in drones:
-                app.logger.info(f'The Drone {drone.serial_number} has {drone.battery_capacity}% of battery')
+            app.logger.info("Audit Log: No drones found in the database.")
+
+# Scheduled jobs. They run in the start_Drone_scheduler processes, not in the web workers. Several of them can be
+# started for failover, the lease elects the one that runs the jobs
+class LeaderLease:
+
+    '''Lease of a row of scheduler_lease. The holder renews it before it expires, the other processes take it over
+    when it has not been renewed for seconds'''
+
+    def __init__(self, name, seconds, owner=None):
+        self.name = name
+        self.seconds = seconds
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.held_until = None
+
+    def renew(self, now=None):
+
+        '''Take or extend the lease if it is free, expired or already ours, returns True if this process holds it'''
+
+        started = time.monotonic()
+        now = now or datetime.utcnow()
+        lease = SchedulerLease.__table__
+        statement = sqlite_insert(lease).values(name=self.name, owner=self.owner, expires_at=now + timedelta(seconds=self.seconds))
+        statement = statement.on_conflict_do_update(
+            index_elements=[lease.c.name],
+            set_={'owner': statement.excluded.owner, 'expires_at': statement.excluded.expires_at},
+            where=(lease.c.owner == self.owner) | (lease.c.expires_at < now))
+        with app.app_context():
+            acquired = db.session.execute(statement).rowcount == 1
+            db.session.commit()
+        # The lease is trusted locally for the time it was taken for, counted from before the statement
+        self.held_until = started + self.seconds if acquired else None
+        return acquired
+
+    def holds(self):
+        return self.held_until is not None and time.monotonic() < self.held_until
+
+    def release(self):
+        with app.app_context():
+            db.session.execute(db.delete(SchedulerLease).where(SchedulerLease.name == self.name,
+                                                               SchedulerLease.owner == self.owner))
+            db.session.commit()
+        self.held_until = None
+
+    def run_if_leader(self, job):
+
+        '''Wrap a job so it only runs in the process that holds the lease'''
+
+        def run():
+            if self.holds():
+                job()
+        return run
+
+def build_scheduler(lease):
 
-# Setting up and starting the task scheduler
-scheduler = BackgroundScheduler()
-scheduler.add_job(check_battery_levels_and_create_audit_log, trigger='interval', seconds=300)  # Run every 300 seconds
-scheduler.start()
+    '''Scheduler of the periodic jobs, the lease is renewed three times per period so a failover takes at most one period'''
+
+    scheduler = BlockingScheduler()
+    scheduler.add_job(lease.renew, trigger='interval', seconds=lease.seconds / 3, next_run_time=datetime.now())
+    scheduler.add_job(lease.run_if_leader(check_battery_levels_and_create_audit_log),
+                      trigger='interval', seconds=AUDIT_INTERVAL_SECONDS, coalesce=True)  # Run every 300 seconds
+    return scheduler
+
+def scheduler_main():
+
+    '''Run the scheduled jobs until the process is stopped'''
+
+    with app.app_context():
+        upgrade_database()
+    lease = LeaderLease('scheduler', app.config['DRONE_SCHEDULER_LEASE'])
+    scheduler = build_scheduler(lease)
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.shutdown(wait=False))
+    try:
+        scheduler.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lease.release()
+
+# Values of the enumerated fields, the validators check them with a set lookup
+DRONE_MODELS = frozenset(["Lightweight", "Middleweight", "Cruiserweight", "Heavyweight"])
+DRONE_STATES = frozenset(["IDLE", "LOADING", "LOADED", "DELIVERING", "DELIVERED", "RETURNING"])
 
 # scheme for validation
 class DroneSchema(Schema):
@@ -98,10 +968,10 @@ class DroneSchema(Schema):
     '''Define the drone scheme for validation'''
     
     serial_number = fields.Str(required=True, metadata={'max_length': 100})
-    model = fields.Str(required=True, validate=lambda s: s in ["Lightweight", "Middleweight", "Cruiserweight", "Heavyweight"])
+    model = fields.Str(required=True, validate=DRONE_MODELS.__contains__)
     weight_limit = fields.Float(required=True, validate=lambda w: 0 <= w <= 500)
     battery_capacity = fields.Float(required=True, validate=lambda b: 0 <= b <= 100)
-    state = fields.Str(required=True, validate=lambda s: s in ["IDLE", "LOADING", "LOADED", "DELIVERING", "DELIVERED", "RETURNING"])
+    state = fields.Str(required=True, validate=DRONE_STATES.__contains__)
 
 
 class MedicationSchema(Schema):
@@ -113,7 +983,597 @@ class MedicationSchema(Schema):
     code = fields.Str(required=True, validate=lambda c: c.isupper() or '_' in c or c.isdigit())
     image = fields.Str(required=True)
 
+class TelemetrySchema(Schema):
+
+    '''Defines the telemetry reading scheme for validating, the time of the reading is the time it is received if it does not have one'''
+
+    serial_number = fields.Str(required=True)
+    battery_capacity = fields.Float(required=True, validate=lambda b: 0 <= b <= 100)
+    state = fields.Str(required=True, validate=DRONE_STATES.__contains__)
+    ts = fields.DateTime(load_default=None)
+
+# Serialization of the responses. The queries select the columns of the response in order, so a row is mapped to
+# its dictionary by position without loading ORM objects. orjson encodes the responses when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def select_rows(statement):
+
+    '''Execute a query of columns on the connection of the session, the rows are returned as they are without the
+    ORM loading step'''
+
+    return db.session.connection(bind_arguments={'clause': statement}).execute(statement)
+
+def map_row(row, field_names):
+
+    '''Dictionary of a row of the selected columns, None if there is no row'''
+
+    return dict(zip(field_names, row)) if row else None
+
+def map_rows(rows, field_names):
+
+    '''Dictionaries of the rows of the selected columns'''
+
+    return [dict(zip(field_names, row)) for row in rows]
+
+def fast_json_enabled():
+    return orjson is not None and app.config['DRONE_JSON_ENCODER'] == 'orjson'
+
+def ndjson_lines(rows, field_names):
+
+    '''NDJSON document of the rows of the selected columns, one line per row'''
+
+    started = time.perf_counter()
+    if fast_json_enabled():
+        document = b''.join(orjson.dumps(dict(zip(field_names, row)), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+    else:
+        document = ''.join(json.dumps(dict(zip(field_names, row))) + '\n' for row in rows)
+    record_serialization(started)
+    return document
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+
+    '''JSON representation of the Flask-RESTful responses'''
+
+    started = time.perf_counter()
+    if not fast_json_enabled():
+        response = flask_restful_output_json(data, code, headers)
+    else:
+        # The validation errors of a list are indexed by the position of the item
+        response = make_response(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS), code)
+        response.headers.extend(headers or {})
+    record_serialization(started)
+    return response
+
+# Pagination and field projection of the list endpoints
+DRONE_FIELDS = ('serial_number', 'model', 'weight_limit', 'battery_capacity', 'state')
+MEDICATION_FIELDS = ('name', 'weight', 'code', 'image')
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+def parse_page_arguments(allowed_fields, args=None):
+
+    '''Read the limit, cursor and fields arguments of a list request, raises ValueError if any of them is invalid.
+    The arguments are the ones of the current Flask request unless others are given'''
+
+    args = request.args if args is None else args
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_LIMIT))
+    except ValueError:
+        raise ValueError('The limit must be an integer')
+    if not 1 <= limit <= MAX_PAGE_LIMIT:
+        raise ValueError(f'The limit must be between 1 and {MAX_PAGE_LIMIT}')
+
+    cursor = args.get('cursor')
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            raise ValueError('Invalid cursor')
+
+    field_names = allowed_fields
+    if args.get('fields'):
+        field_names = tuple(name.strip() for name in args['fields'].split(',') if name.strip())
+        unknown_fields = [name for name in field_names if name not in allowed_fields]
+        if unknown_fields or not field_names:
+            raise ValueError(f'Unknown fields: {", ".join(unknown_fields)}')
+
+    return limit, cursor, field_names
+
+def page_statement(model, field_names, limit, cursor=None):
+
+    '''Build the keyset paginated query of the requested columns, the id is always selected first to build the next cursor'''
+
+    statement = db.select(model.id, *[getattr(model, name) for name in field_names])
+    if cursor is not None:
+        statement = statement.where(model.id > cursor)
+    # One extra row tells if there is a next page
+    return statement.order_by(model.id).limit(limit + 1)
+
+def build_page(rows, field_names, limit):
+
+    '''Convert the rows of a page to dictionaries and get the cursor of the next page'''
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1][0])
+    return map_rows((row[1:] for row in rows), field_names), next_cursor
+
+# Streaming of the list endpoints
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_BATCH_SIZE = 500
+
+def wants_ndjson(accept_mimetypes=None):
+
+    '''Check if the client asked for a streamed NDJSON response instead of a JSON document'''
+
+    accept_mimetypes = request.accept_mimetypes if accept_mimetypes is None else accept_mimetypes
+    return accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def export_statement(model, field_names, cursor=None):
+
+    '''Build the query of all the rows of a table in id order, starting after the cursor if there is one'''
+
+    statement = db.select(*[getattr(model, name) for name in field_names])
+    if cursor is not None:
+        statement = statement.where(model.id > cursor)
+    return statement.order_by(model.id)
+
+def stream_rows(statement, field_names):
+
+    '''Send the rows of a query as NDJSON, one line per row. The rows are fetched from the database in batches
+    of STREAM_BATCH_SIZE while the response is being sent, so the whole table is never held in memory'''
+
+    def generate():
+        result = db.session.execute(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+        for rows in result.partitions():
+            yield ndjson_lines(rows, field_names)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+# Conditional requests of the read endpoints
+def change_sequence_statement(tables):
+
+    '''Query of the change sequence of the tables'''
+
+    return db.select(ChangeSequence.table_name, ChangeSequence.seq) \
+        .where(ChangeSequence.table_name.in_(tables)).order_by(ChangeSequence.table_name)
+
+def response_etag(full_path, ndjson, versions):
+
+    '''ETag of a response from the path and arguments of the request, its format and the change sequence of the tables'''
+
+    version_key = ','.join(f'{table_name}={seq}' for table_name, seq in versions)
+    return hashlib.sha1(f'{full_path}|{ndjson}|{version_key}'.encode()).hexdigest()
+
+def conditional_get(tables, build_response):
+
+    '''Answer 304 if the If-None-Match header of the request has the current ETag, otherwise build the response and tag it.
+    The ETag comes from the change sequence of the tables the response is read from, it is computed with one small
+    query and without building the response'''
+
+    versions = select_rows(change_sequence_statement(tables)).all()
+    etag = response_etag(request.full_path, wants_ndjson(), versions)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    response = build_response()
+    if isinstance(response, Response):
+        if response.status_code == 200:
+            response.set_etag(etag)
+        return response
+    data, status = response if isinstance(response, tuple) else (response, 200)
+    if status != 200:
+        return response
+    return data, 200, {'ETag': f'"{etag}"'}
+
+# Read-through cache of the drone and medication lookups
+class LRUCache:
+
+    '''Bounded cache of the process, the least recently used entry is dropped when it is full and every entry
+    expires ttl seconds after it was stored'''
+
+    def __init__(self, maxsize=4096, ttl=5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class RedisCache:
+
+    '''Cache shared by every worker process, stored in Redis. The redis package is only needed when it is used'''
+
+    def __init__(self, url, ttl=5.0, prefix='drone-api:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+class ReadThroughCache:
+
+    '''Return the cached value of a key or load it and store it. The entries are kept in a backend with the methods
+    get, set, delete and clear: LRUCache keeps them in the process and RedisCache shares them between processes'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        value = self.backend.get(key)
+        if self._count(value):
+            return value
+        # Missing rows are not cached so creating a row never needs an invalidation
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    async def aget(self, key, loader):
+
+        '''Same as get for the ASGI app, the loader is a coroutine function'''
+
+        value = self.backend.get(key)
+        if self._count(value):
+            return value
+        value = await loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def _count(self, value):
+        with self._lock:
+            if value is not None:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def invalidate(self, *keys):
+        self.backend.delete(*keys)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': type(self.backend).__name__, 'hits': self.hits, 'misses': self.misses}
+
+def make_cache_backend():
+
+    '''Build the backend of the lookup cache from the configuration'''
+
+    if app.config['DRONE_CACHE_REDIS_URL']:
+        return RedisCache(app.config['DRONE_CACHE_REDIS_URL'], ttl=app.config['DRONE_CACHE_TTL'])
+    return LRUCache(maxsize=app.config['DRONE_CACHE_SIZE'], ttl=app.config['DRONE_CACHE_TTL'])
+
+lookup_cache = ReadThroughCache(make_cache_backend())
+
+def drone_key(serial_number):
+
+    '''Key of a drone in the lookup cache'''
+
+    return f'drone:{serial_number}'
+
+def medication_key(code):
+
+    '''Key of a medication in the lookup cache'''
+
+    return f'medication:{code}'
+
+def drone_statement(serial_number):
+
+    '''Query of the fields of a drone from its serial number'''
+
+    return db.select(*[getattr(Drone, name) for name in DRONE_FIELDS]).where(Drone.serial_number == serial_number)
+
+def medication_statement(code):
+
+    '''Query of the fields of a medication from its code'''
+
+    return db.select(*[getattr(Medication, name) for name in MEDICATION_FIELDS]).where(Medication.code == code)
+
+def load_drone(serial_number):
+
+    '''Get the fields of a drone from its serial number, through the lookup cache'''
+
+    def loader():
+        return map_row(select_rows(drone_statement(serial_number)).first(), DRONE_FIELDS)
+    return lookup_cache.get(drone_key(serial_number), loader)
+
+def load_medication(code):
+
+    '''Get the fields of a medication from its code, through the lookup cache'''
+
+    def loader():
+        return map_row(select_rows(medication_statement(code)).first(), MEDICATION_FIELDS)
+    return lookup_cache.get(medication_key(code), loader)
+
+# In-process index of the fleet for the dispatch queries
+# Arguments of the available drones service answered by the fleet index
+FLEET_ARGUMENTS = {'model', 'min_battery', 'min_capacity'}
+# Number of drones above which a write reloads the whole index instead of its drones
+FLEET_REFRESH_LIMIT = 500
+
+def fleet_statement():
+
+    '''Query of the columns of the drones kept by the fleet index'''
+
+    return db.select(Drone.id, Drone.serial_number, Drone.model, Drone.weight_limit, Drone.battery_capacity, Drone.state,
+                     Drone.weight_limit - Drone.current_payload_weight)
+
+class FleetBucket:
+
+    '''Drones of a state and model, sorted by battery level and by remaining capacity'''
+
+    def __init__(self, drones=()):
+        # The (drone_id, battery, capacity) of the drones are sorted once, the updates keep the order
+        self.by_battery = sorted((battery, drone_id, capacity) for drone_id, battery, capacity in drones)
+        self.by_capacity = sorted((capacity, drone_id, battery) for drone_id, battery, capacity in drones)
+
+    def add(self, drone_id, battery, capacity):
+        bisect.insort(self.by_battery, (battery, drone_id, capacity))
+        bisect.insort(self.by_capacity, (capacity, drone_id, battery))
+
+    def remove(self, drone_id, battery, capacity):
+        del self.by_battery[bisect.bisect_left(self.by_battery, (battery, drone_id, capacity))]
+        del self.by_capacity[bisect.bisect_left(self.by_capacity, (capacity, drone_id, battery))]
+
+    def query(self, min_battery, min_capacity):
+
+        '''Ids of the drones with at least min_battery and min_capacity. The most selective order gives the candidates
+        and the other value is checked on them'''
+
+        battery_start = bisect.bisect_left(self.by_battery, (min_battery,))
+        capacity_start = bisect.bisect_left(self.by_capacity, (min_capacity - WEIGHT_EPSILON,))
+        if len(self.by_battery) - battery_start <= len(self.by_capacity) - capacity_start:
+            return [drone_id for battery, drone_id, capacity in self.by_battery[battery_start:]
+                    if capacity >= min_capacity - WEIGHT_EPSILON]
+        return [drone_id for capacity, drone_id, battery in self.by_capacity[capacity_start:] if battery >= min_battery]
+
+class FleetIndex:
+
+    '''Drones kept in memory in buckets by state and model to answer the dispatch queries without the database.
+    The write paths of the process update the drones they change, and when the index is older than ttl seconds it is
+    rebuilt by a background thread so the writes of the other processes are seen. The queries keep using the current
+    index meanwhile, and the changes applied during the rebuild are applied again to the new one'''
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._drones = {}
+        self._ids = {}
+        self._buckets = {}
+        self._loaded_at = None
+        self._generation = 0
+        self._changes = None
+        self.reloader = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def build(rows):
+
+        '''Drones, ids by serial number and buckets of the index of the rows of fleet_statement()'''
+
+        drones, ids, bucket_drones = {}, {}, {}
+        for row in rows:
+            row = tuple(row)
+            drone_id, serial_number, model, weight_limit, battery, state, capacity = row
+            drones[drone_id] = row
+            ids[serial_number] = drone_id
+            bucket_drones.setdefault((state, model), []).append((drone_id, battery, capacity))
+        return drones, ids, {key: FleetBucket(entries) for key, entries in bucket_drones.items()}
+
+    def _add(self, row):
+        drone_id, serial_number, model, weight_limit, battery, state, capacity = row
+        self._drones[drone_id] = row
+        self._ids[serial_number] = drone_id
+        self._buckets.setdefault((state, model), FleetBucket()).add(drone_id, battery, capacity)
+
+    def _remove(self, serial_number):
+        drone_id = self._ids.pop(serial_number, None)
+        if drone_id is not None:
+            drone_id, serial_number, model, weight_limit, battery, state, capacity = self._drones.pop(drone_id)
+            self._buckets[(state, model)].remove(drone_id, battery, capacity)
+
+    def _read(self):
+        with app.app_context():
+            return select_rows(fleet_statement()).all()
+
+    def _load(self):
+        self._drones, self._ids, self._buckets = self.build(self._read())
+        self._loaded_at = time.monotonic()
+        # A rebuild started before is older than this load
+        self._generation += 1
+        self._changes = None
+
+    def _reload(self, generation):
+        try:
+            drones, ids, buckets = self.build(self._read())
+            with self._lock:
+                if generation != self._generation:
+                    return
+                changes = self._changes or []
+                self._drones, self._ids, self._buckets = drones, ids, buckets
+                for change, arguments in changes:
+                    change(*arguments)
+                self._loaded_at = time.monotonic()
+        except Exception:
+            app.logger.exception('The fleet index could not be rebuilt')
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    self._changes = None
+
+    def _record(self, change, *arguments):
+        if self._changes is not None:
+            self._changes.append((change, arguments))
+        change(*arguments)
+
+    def invalidate(self):
+
+        '''Reload the whole index on the next query'''
+
+        with self._lock:
+            self._loaded_at = None
+            self._generation += 1
+            self._changes = None
+
+    def _apply(self, serial_numbers, rows):
+        for serial_number in serial_numbers:
+            self._remove(serial_number)
+        for row in rows:
+            self._remove(row[1])
+            self._add(tuple(row))
+
+    def apply(self, serial_numbers, rows):
+
+        '''Replace the drones of the serial numbers by the rows read from the database after a write, the drones
+        without a row no longer exist'''
+
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._record(self._apply, serial_numbers, rows)
+
+    def refresh(self, serial_numbers):
+
+        '''Read the drones of the serial numbers from the database after a write and update them in the index'''
+
+        serial_numbers = set(serial_numbers)
+        if len(serial_numbers) > FLEET_REFRESH_LIMIT:
+            self.invalidate()
+            return
+        if self._loaded_at is None or not serial_numbers:
+            return
+        with app.app_context():
+            rows = select_rows(fleet_statement().where(Drone.serial_number.in_(serial_numbers))).all()
+        self.apply(serial_numbers, rows)
+
+    def apply_readings(self, readings):
+
+        '''Update the battery level and the state of the drones from the telemetry readings written to the database'''
+
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._record(self._apply_readings, readings)
+
+    def _apply_readings(self, readings):
+        for serial_number, reading in readings.items():
+            drone_id = self._ids.get(serial_number)
+            if drone_id is None:
+                continue
+            drone_id, serial_number, model, weight_limit, battery, state, capacity = self._drones[drone_id]
+            if can_move(state, reading['state'], battery):
+                state = reading['state']
+            self._remove(serial_number)
+            self._add((drone_id, serial_number, model, weight_limit, reading['battery_capacity'], state, capacity))
+
+    def query(self, state='IDLE', model=None, min_battery=0.0, min_capacity=0.0):
+
+        '''Fields of the drones in the state, of the model if given, with at least min_battery and min_capacity, in id order'''
+
+        with self._lock:
+            if self._loaded_at is None:
+                self._load()
+            elif time.monotonic() - self._loaded_at > self.ttl and self._changes is None:
+                # Rebuild in the background, the changes of the write paths are kept to apply them to the new index
+                self._changes = []
+                self.reloader = threading.Thread(target=self._reload, args=(self._generation,), daemon=True)
+                self.reloader.start()
+            if model is not None:
+                buckets = [self._buckets[(state, model)]] if (state, model) in self._buckets else []
+            else:
+                buckets = [bucket for (bucket_state, bucket_model), bucket in self._buckets.items() if bucket_state == state]
+            drone_ids = sorted(drone_id for bucket in buckets for drone_id in bucket.query(min_battery, min_capacity))
+            return [dict(zip(DRONE_FIELDS, self._drones[drone_id][1:6])) for drone_id in drone_ids]
+
+fleet_index = FleetIndex(ttl=app.config['DRONE_FLEET_INDEX_TTL'])
+
+def parse_fleet_arguments(args):
+
+    '''Read the model, min_battery and min_capacity arguments of a fleet query, raises ValueError if any of them is invalid'''
+
+    model = args.get('model') or None
+    if model is not None and model not in DRONE_MODELS:
+        raise ValueError(f'The model must be one of {", ".join(sorted(DRONE_MODELS))}')
+    try:
+        min_battery = float(args.get('min_battery') or 0)
+        min_capacity = float(args.get('min_capacity') or 0)
+    except ValueError:
+        raise ValueError('The min_battery and min_capacity arguments must be numbers')
+    return model, min_battery, min_capacity
+
 # Class to manage resources
+def drone_update(serial_number, drone, updated_data):
+
+    '''Build the update of a PUT request for the drone read with its state, version and battery capacity, returns the
+    statement, None when there is nothing to update, and the error response if the update is not allowed. A state change
+    must follow the lifecycle and is conditional on the state and version read, as the transitions'''
+
+    # Check battery level before allowing the state change to LOADING
+    if updated_data.get('state') == 'LOADING' and drone.battery_capacity >= 25:
+        return None, ({'message': 'Drone cannot be in LOADING state with battery level up 25%'}, 400)
+    if not updated_data:
+        return None, None
+
+    statement = db.update(Drone).where(Drone.serial_number == serial_number)
+    if updated_data.get('state', drone.state) != drone.state:
+        if updated_data['state'] != NEXT_STATE[drone.state]:
+            return None, ({'message': f'Drone cannot move from {drone.state} to {updated_data["state"]}',
+                           'state': drone.state, 'version': drone.version}, 409)
+        statement = statement.where(Drone.state == drone.state, Drone.version == drone.version).values(version=Drone.version + 1)
+        if updated_data['state'] == 'LOADING':
+            statement = statement.where(Drone.battery_capacity < 25)
+    return statement.values(**updated_data).execution_options(synchronize_session=False), None
+
 class DroneResource(Resource):
 
     '''Defines the class to manage the drone resources. Path to access these class /drones/<string:serial_number>'''
@@ -125,22 +1585,34 @@ class DroneResource(Resource):
         '''Obtain either all drones or a specific drone by its serial number'''
         
         if serial_number:
-            # Obtain a medication from its serial number
-            drone = Drone.query.filter_by(serial_number=serial_number).first()
+            # Obtain a drone from its serial number
+            drone = load_drone(serial_number)
             if drone:
-                return {'serial_number': drone.serial_number, 'model': drone.model, 'weight_limit': drone.weight_limit,
-                        'battery_capacity': drone.battery_capacity, 'state': drone.state}
+                return drone
             else:
                 return {'message': 'Drone not found'}, 404
         else:
-            # List of all Drones
-            drones = Drone.query.all()
-            if not drones:
-                return {'message': 'There are no drones in the database'}
-
-            drone_list = [{'serial_number': drone.serial_number, 'model': drone.model, 'weight_limit': drone.weight_limit,
-                           'battery_capacity': drone.battery_capacity, 'state': drone.state} for drone in drones]
-            return {'drones': drone_list}
+            # Page of Drones, not sent again if the client has the current version
+            return conditional_get(['drone'], self.get_page)
+
+    def get_page(self):
+
+        '''Obtain a page of drones, or all of them as NDJSON'''
+
+        try:
+            limit, cursor, field_names = parse_page_arguments(DRONE_FIELDS)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        if wants_ndjson():
+            return stream_rows(export_statement(Drone, field_names, cursor), field_names)
+
+        rows = select_rows(page_statement(Drone, field_names, limit, cursor)).all()
+        if not rows and cursor is None:
+            return {'message': 'There are no drones in the database'}
+
+        drone_list, next_cursor = build_page(rows, field_names, limit)
+        return {'drones': drone_list, 'next_cursor': next_cursor}
             
     def post(self):
     
@@ -152,7 +1624,7 @@ class DroneResource(Resource):
         except ValidationError as e:
             return {'message': 'Validation error', 'errors': e.messages}, 400
 
-        existing_drone = Drone.query.filter_by(serial_number=new_drone['serial_number']).first()
+        existing_drone = select_rows(db.select(Drone.id).where(Drone.serial_number == new_drone['serial_number'])).first()
         if existing_drone:
             return {'message': 'There is already a drone with this serial number'}, 400
         
@@ -161,8 +1633,9 @@ class DroneResource(Resource):
             return {'message': 'Drone cannot be in LOADING state with battery level up 25%'}, 400
 
         
-        db.session.add(Drone(**new_drone))
+        db.session.execute(db.insert(Drone), [new_drone])
         db.session.commit()
+        fleet_index.refresh([new_drone['serial_number']])
 
         return {'message': 'Drone successfully created'}, 201
 
@@ -177,18 +1650,22 @@ class DroneResource(Resource):
         except ValidationError as e:
             return {'message': 'Validation error', 'errors': e.messages}, 400
 
-        drone = Drone.query.filter_by(serial_number=serial_number).first()
+        drone = select_rows(db.select(Drone.state, Drone.version, Drone.battery_capacity)
+                            .where(Drone.serial_number == serial_number)).first()
         
         if drone:           
-            # Check battery level before allowing the state change to LOADING
-            
-            if updated_data.get('state') == 'LOADING' and drone.battery_capacity >= 25:
-                return {'message': 'Drone cannot be in LOADING state with battery level up 25%'}, 400
+            statement, error = drone_update(serial_number, drone, updated_data)
+            if error:
+                return error
 
             # Update Drone
-            for key, value in updated_data.items():
-                setattr(drone, key, value)
-            db.session.commit()
+            if statement is not None:
+                updated = db.session.execute(statement)
+                db.session.commit()
+                if not updated.rowcount:
+                    return {'message': 'Drone was modified by another request'}, 409
+            lookup_cache.invalidate(drone_key(serial_number), drone_key(updated_data.get('serial_number', serial_number)))
+            fleet_index.refresh([serial_number, updated_data.get('serial_number', serial_number)])
                 
             return {'message': 'Drone updated successfully'}
         else:
@@ -196,21 +1673,233 @@ class DroneResource(Resource):
 
     def delete(self, serial_number):
     
-        '''Delete a drone based on its serial number'''
-        drone = Drone.query.filter_by(serial_number=serial_number).first()
+        '''Delete a drone based on its serial number, the database deletes its medications and its battery history'''
+        deleted = db.session.execute(db.delete(Drone).where(Drone.serial_number == serial_number)
+                                     .execution_options(synchronize_session=False))
 
-        if drone:
-            # Search and delete in DroneMedication
-            drone_medications = DroneMedication.query.filter_by(drone_id=drone.id).all()
-            for drone_medication in drone_medications:
-                db.session.delete(drone_medication)
-
-            db.session.delete(drone)
+        if deleted.rowcount:
             db.session.commit()
+            lookup_cache.invalidate(drone_key(serial_number))
+            fleet_index.refresh([serial_number])
             return {'message': 'Drone deleted successfully'}
         else:
             return {'message': 'Drone not found'}, 404
 
+# Lifecycle of a drone, every state can only move to the next one
+DRONE_LIFECYCLE = ("IDLE", "LOADING", "LOADED", "DELIVERING", "DELIVERED", "RETURNING")
+NEXT_STATE = {state: DRONE_LIFECYCLE[(position + 1) % len(DRONE_LIFECYCLE)] for position, state in enumerate(DRONE_LIFECYCLE)}
+PREVIOUS_STATE = {next_state: state for state, next_state in NEXT_STATE.items()}
+
+def can_move(state, new_state, battery_capacity):
+
+    '''Whether a drone in state with battery_capacity can move to new_state, the next state of its lifecycle'''
+
+    # Check battery level before allowing the state change to LOADING
+    return PREVIOUS_STATE[new_state] == state and (new_state != 'LOADING' or battery_capacity < 25)
+
+class TransitionSchema(Schema):
+
+    '''Defines the drone transition scheme for validation, the version is the one the client read if it is given'''
+
+    state = fields.Str(required=True, validate=DRONE_STATES.__contains__)
+    version = fields.Int(load_default=None)
+
+class DroneTransitionResource(Resource):
+
+    '''Defines the class to move a drone to the next state of its lifecycle. Path to access these class /drones/<string:serial_number>/transition'''
+
+    transition_schema = TransitionSchema()
+
+    def post(self, serial_number):
+
+        '''Move the drone to the state of the request if it is the next one of its current state. The transition is a single
+        conditional update on the expected state, and on the version if it is given, so of two concurrent requests only one succeeds'''
+
+        try:
+            data = self.transition_schema.load(request.get_json())
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        expected_state = PREVIOUS_STATE[data['state']]
+        statement = db.update(Drone).where(Drone.serial_number == serial_number, Drone.state == expected_state)
+        if data['version'] is not None:
+            statement = statement.where(Drone.version == data['version'])
+        if data['state'] == 'LOADING':
+            # Check battery level before allowing the state change to LOADING
+            statement = statement.where(Drone.battery_capacity < 25)
+        version = db.session.execute(statement.values(state=data['state'], version=Drone.version + 1)
+                                     .returning(Drone.version).execution_options(synchronize_session=False)).scalar()
+        db.session.commit()
+
+        if version is None:
+            # Find out why the update did not match
+            drone = select_rows(db.select(Drone.state, Drone.version, Drone.battery_capacity)
+                                .where(Drone.serial_number == serial_number)).first()
+            if drone is None:
+                return {'message': 'Drone not found'}, 404
+            if drone.state != expected_state:
+                return {'message': f'Drone cannot move from {drone.state} to {data["state"]}',
+                        'state': drone.state, 'version': drone.version}, 409
+            if data['version'] is not None and drone.version != data['version']:
+                return {'message': 'Drone was modified by another request', 'state': drone.state, 'version': drone.version}, 409
+            return {'message': 'Drone cannot be in LOADING state with battery level up 25%'}, 400
+
+        lookup_cache.invalidate(drone_key(serial_number))
+        fleet_index.refresh([serial_number])
+        return {'serial_number': serial_number, 'state': data['state'], 'version': version}
+
+# Maximum number of drones created by one bulk request
+MAX_BULK_ITEMS = 10000
+
+class DroneBulkResource(Resource):
+
+    '''Defines the class to create many drones in one request. Path to access these class /drones/bulk'''
+
+    drones_schema = DroneSchema(many=True)
+
+    def post(self):
+
+        '''Save a list of drones in a single transaction and report the result of every item'''
+
+        data = request.get_json()
+        if not isinstance(data, list) or not data:
+            return {'message': 'A non empty list of drones is required'}, 400
+        if len(data) > MAX_BULK_ITEMS:
+            return {'message': f'No more than {MAX_BULK_ITEMS} drones can be created in one request'}, 400
+
+        # Validate the whole list at once, the errors are indexed by the position of the drone
+        try:
+            loaded_drones = self.drones_schema.load(data)
+            errors = {}
+        except ValidationError as e:
+            loaded_drones = e.valid_data
+            errors = e.messages
+
+        # Look for the serial numbers that already exist with a single query
+        serial_numbers = {drone['serial_number'] for index, drone in enumerate(loaded_drones)
+                          if index not in errors}
+        existing_serials = set(db.session.scalars(
+            db.select(Drone.serial_number).where(Drone.serial_number.in_(serial_numbers))))
+
+        results = []
+        new_drones = []
+        for index, drone in enumerate(loaded_drones):
+            result = {'index': index, 'serial_number': drone.get('serial_number')}
+            if index in errors:
+                result.update(status='invalid', errors=errors[index])
+            elif drone['serial_number'] in existing_serials:
+                result.update(status='duplicate', message='There is already a drone with this serial number')
+            elif drone['state'] == 'LOADING' and drone['battery_capacity'] >= 25:
+                result.update(status='rejected', message='Drone cannot be in LOADING state with battery level up 25%')
+            else:
+                # Later repetitions of the serial number in the same request are duplicates
+                existing_serials.add(drone['serial_number'])
+                new_drones.append(drone)
+                result['status'] = 'created'
+            results.append(result)
+
+        if new_drones:
+            db.session.execute(db.insert(Drone), new_drones)
+            db.session.commit()
+            fleet_index.refresh([drone['serial_number'] for drone in new_drones])
+
+        response = {'created': len(new_drones), 'failed': len(results) - len(new_drones), 'results': results}
+        return response, 201 if new_drones else 400
+
+# Battery history returned when the request has no time range
+DEFAULT_HISTORY_RANGE = timedelta(days=1)
+
+def parse_time_range():
+
+    '''Read the from and to arguments of a request as ISO 8601 datetimes, raises ValueError if any of them is invalid.
+    Datetimes with an offset are converted to naive UTC, as the audit is saved'''
+
+    def argument(name):
+        value = datetime.fromisoformat(request.args[name])
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    try:
+        end = argument('to') if request.args.get('to') else datetime.utcnow()
+        start = argument('from') if request.args.get('from') else end - DEFAULT_HISTORY_RANGE
+    except ValueError:
+        raise ValueError('The from and to arguments must be ISO 8601 datetimes')
+    if start > end:
+        raise ValueError('The from argument must be before the to argument')
+    return start, end
+
+# Maximum number of points of a battery history when the request does not give it
+DEFAULT_HISTORY_POINTS = 500
+
+def history_points(start, end, resolution):
+
+    '''Number of points of the range at the resolution, a rollup has a point for every bucket the range touches'''
+
+    if resolution == 'raw':
+        return (end - start).total_seconds() / AUDIT_INTERVAL_SECONDS
+    seconds = ROLLUP_RESOLUTIONS[resolution]
+    return (end - bucket_start(start, seconds)) // timedelta(seconds=seconds) + 1
+
+def history_resolution(start, end, points):
+
+    '''Pick the most detailed resolution whose number of points in the range is within points, the raw audit
+    is used for short ranges and the coarsest rollup when every resolution has more points'''
+
+    for name in ['raw'] + sorted(ROLLUP_RESOLUTIONS, key=ROLLUP_RESOLUTIONS.get):
+        if history_points(start, end, name) <= points:
+            return name
+    return max(ROLLUP_RESOLUTIONS, key=ROLLUP_RESOLUTIONS.get)
+
+class BatteryHistoryResource(Resource):
+
+    '''Defines the class to get the battery audit of a drone. Path to access these class /drones/<string:serial_number>/battery-history'''
+
+    def get(self, serial_number):
+
+        '''Obtain the battery levels saved by the audit between the from and to arguments, by default the last day.
+        The resolution is raw, 1h or 1d, when it is not given it is chosen from the range and the points argument'''
+
+        try:
+            start, end = parse_time_range()
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        try:
+            points = int(request.args.get('points', DEFAULT_HISTORY_POINTS))
+        except ValueError:
+            points = 0
+        if points < 1:
+            return {'message': 'The points argument must be a positive integer'}, 400
+
+        resolution = request.args.get('resolution') or history_resolution(start, end, points)
+        if resolution != 'raw' and resolution not in ROLLUP_RESOLUTIONS:
+            return {'message': f'The resolution must be raw, {", ".join(ROLLUP_RESOLUTIONS)}'}, 400
+        if history_points(start, end, resolution) > points:
+            return {'message': f'The range has more than {points} points at the {resolution} resolution, use a shorter range, '
+                               f'a coarser resolution or a larger points argument'}, 400
+
+        drone_id = db.session.scalar(db.select(Drone.id).where(Drone.serial_number == serial_number))
+        if drone_id is None:
+            return {'message': 'Drone not found'}, 404
+
+        if resolution == 'raw':
+            rows = db.session.execute(db.select(BatteryAudit.ts, BatteryAudit.battery_capacity)
+                                      .where(BatteryAudit.drone_id == drone_id, BatteryAudit.ts.between(start, end))
+                                      .order_by(BatteryAudit.ts).limit(points)).all()
+            history = [{'ts': ts.isoformat(), 'battery_capacity': battery_capacity} for ts, battery_capacity in rows]
+        else:
+            seconds = ROLLUP_RESOLUTIONS[resolution]
+            rows = db.session.execute(db.select(BatteryRollup.bucket, BatteryRollup.samples, BatteryRollup.battery_sum,
+                                                BatteryRollup.battery_min, BatteryRollup.battery_max)
+                                      .where(BatteryRollup.drone_id == drone_id, BatteryRollup.resolution == seconds,
+                                             BatteryRollup.bucket.between(bucket_start(start, seconds), end))
+                                      .order_by(BatteryRollup.bucket).limit(points)).all()
+            history = [{'ts': bucket.isoformat(), 'battery_min': battery_min, 'battery_avg': battery_sum / samples,
+                        'battery_max': battery_max}
+                       for bucket, samples, battery_sum, battery_min, battery_max in rows]
+
+        return {'serial_number': serial_number, 'resolution': resolution, 'battery_history': history}
+
 class MedicationResource(Resource):
 
     '''Defines the class to manage the medication resources. Path to access these class /medications/<string:code>'''
@@ -222,20 +1911,34 @@ class MedicationResource(Resource):
         '''Obtain either all medications or a specific medication by its code'''
         
         if code:
-            # Obtain a medication from its serial number
-            medication = Medication.query.filter_by(code=code).first()
+            # Obtain a medication from its code
+            medication = load_medication(code)
             if medication:
-                return {'name': medication.name, 'weight': medication.weight, 'code': medication.code, 'image': medication.image}
+                return medication
             else:
                 return {'message': 'Medication not found'}, 404
         else:
-            # Obtener la lista de todas las medicaciones
-            medications = Medication.query.all()
-            if not medications:
-                return {'message': 'There are no medications in the database'}
+            # Page of Medications, not sent again if the client has the current version
+            return conditional_get(['medication'], self.get_page)
+
+    def get_page(self):
+
+        '''Obtain a page of medications, or all of them as NDJSON'''
+
+        try:
+            limit, cursor, field_names = parse_page_arguments(MEDICATION_FIELDS)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        if wants_ndjson():
+            return stream_rows(export_statement(Medication, field_names, cursor), field_names)
 
-            medication_list = [{'name': med.name, 'weight': med.weight, 'code': med.code, 'image': med.image} for med in medications]
-            return {'medications': medication_list}
+        rows = select_rows(page_statement(Medication, field_names, limit, cursor)).all()
+        if not rows and cursor is None:
+            return {'message': 'There are no medications in the database'}
+
+        medication_list, next_cursor = build_page(rows, field_names, limit)
+        return {'medications': medication_list, 'next_cursor': next_cursor}
             
     def post(self):
     
@@ -247,11 +1950,11 @@ class MedicationResource(Resource):
         except ValidationError as e:
             return {'message': 'Validation error', 'errors': e.messages}, 400
 
-        existing_medication = Medication.query.filter_by(code=new_medication['code']).first()
+        existing_medication = select_rows(db.select(Medication.id).where(Medication.code == new_medication['code'])).first()
         if existing_medication:
             return {'message': 'There is already a Medication with this code'}, 400
 
-        db.session.add(Medication(**new_medication))
+        db.session.execute(db.insert(Medication), [new_medication])
         db.session.commit()
 
         return {'message': 'Medication created successfully'}, 201
@@ -270,10 +1973,18 @@ class MedicationResource(Resource):
         medication = Medication.query.filter_by(code=code).first()
 
         if medication:
+            # Keep the payload weight of the drones that carry the medication
+            if 'weight' in updated_data and updated_data['weight'] != medication.weight:
+                adjust_payload_weight(medication.id, updated_data['weight'] - medication.weight)
+
             # Update Medication
             for key, value in updated_data.items():
                 setattr(medication, key, value)
             db.session.commit()
+            lookup_cache.invalidate(medication_key(code), medication_key(updated_data.get('code', code)))
+            if 'weight' in updated_data:
+                # The remaining capacity of every drone that carries it changes
+                fleet_index.invalidate()
             return {'message': 'Medication updated successfully'}
         else:
             return {'message': 'Medication not found'}, 404
@@ -282,15 +1993,15 @@ class MedicationResource(Resource):
         
         '''Delete a medication based on its serial number'''
         
-        medication = Medication.query.filter_by(code=code).first()
+        medication = db.session.execute(db.select(Medication.id, Medication.weight).where(Medication.code == code)).first()
         if medication:
-            # Buscar y eliminar en DroneMedication
-            drone_medications = DroneMedication.query.filter_by(medication_id=medication.id).all()
-            for drone_medication in drone_medications:
-                db.session.delete(drone_medication)
-
-            db.session.delete(medication)
+            adjust_payload_weight(medication.id, -medication.weight)
+            # The database deletes its associations with the drones
+            db.session.execute(db.delete(Medication).where(Medication.id == medication.id)
+                               .execution_options(synchronize_session=False))
             db.session.commit()
+            lookup_cache.invalidate(medication_key(code))
+            fleet_index.invalidate()
             return {'message': 'Medication deleted successfully'}
         else:
             return {'message': 'Medication not found'}, 404
@@ -314,53 +2025,484 @@ class DroneWithMedicationResource(Resource):
             # If the drone does not exist, return an error
             return {'message': 'Drone not found with the given serial number'}, 404
 
-        #Obtain all medications that will be charged
-        medication_codes = data.get('medication_codes', [])
-        existing_medications = Medication.query.filter(Medication.code.in_(medication_codes)).all()
+        #Obtain all medications that will be charged, a repeated code is only loaded once
+        medication_codes = list(dict.fromkeys(data.get('medication_codes', [])))
+        existing_medications = db.session.execute(
+            db.select(Medication.id, Medication.name, Medication.weight, Medication.code)
+            .where(Medication.code.in_(medication_codes))).all()
         
         # Check if any medication does not exist
         if len(existing_medications) != len(medication_codes):
             non_existing_codes = set(medication_codes) - set(med.code for med in existing_medications)
             return {'message': f'The following medication codes do not exist: {", ".join(non_existing_codes)}'}, 404
 
-
         # Validate that the association does not previously exist in DroneMedication
-        not_association = []
-        massage = []
-        for medication in existing_medications:
-            
-            existing_association = DroneMedication.query.filter_by(drone_id=existing_drone.id,
-                                                                   medication_id=medication.id).first()
-            if not existing_association:
-                not_association.append(medication)
-            else:
-                massage.append(f'The medication {medication.name} is already associated with the drone')
-
+        medication_ids = [med.id for med in existing_medications]
+        associated_ids = set(db.session.scalars(
+            db.select(DroneMedication.medication_id)
+            .where(DroneMedication.drone_id == existing_drone.id, DroneMedication.medication_id.in_(medication_ids))))
+        massage = [f'The medication {medication.name} is already associated with the drone'
+                   for medication in existing_medications if medication.id in associated_ids]
         if massage:
             return {'message': massage}, 400
 
-        # Validate the weight of medications
-        total_weight = sum(med.weight for med in not_association)
+        # Validate the weight of medications and reserve it on the drone counter in the same statement,
+        # the update only matches if the new payload is within the drone limit
+        added_weight = sum(med.weight for med in existing_medications)
+        reserved = db.session.execute(reserve_payload_update(existing_drone.id, added_weight))
+        if reserved.rowcount == 0:
+            db.session.rollback()
+            return {'message': 'Weight of medications exceeds drone limit'}, 400
 
-        existing_association = db.session.query(Medication.name, Medication.weight, Medication.code,
-                                                Medication.image). \
-            join(DroneMedication, Medication.id == DroneMedication.medication_id). \
-            filter(DroneMedication.drone_id == existing_drone.id).all()
+        # Create the medications associated with the drone with a single insert, the unique index rejects the
+        # medications loaded by a concurrent request since they were checked
+        try:
+            if medication_ids:
+                db.session.execute(db.insert(DroneMedication),
+                                   [{'drone_id': existing_drone.id, 'medication_id': medication_id}
+                                    for medication_id in medication_ids])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'The medications were loaded onto the drone by another request'}, 409
+        lookup_cache.invalidate(drone_key(drone_data['serial_number']))
+        fleet_index.refresh([drone_data['serial_number']])
 
-        total_weight += sum(med.weight for med in existing_association)
+        return {'message': 'Drone with medications created successfully'}, 201
+        
+# Loading of many drones in one request
+BATCH_LOAD_MODES = frozenset(['all_or_nothing', 'best_effort'])
 
-        if total_weight > existing_drone.weight_limit:
-            return {'message': 'Weight of medications exceeds drone limit'}, 400
+class LoadEntrySchema(Schema):
 
-        # Create the medications associated with the drone
-        for medication in not_association:
-            new_association = DroneMedication(drone_id=existing_drone.id, medication_id=medication.id)
-            db.session.add(new_association)
+    '''Defines the scheme of a drone and its medications in a batch load'''
 
-        db.session.commit()
+    serial_number = fields.Str(required=True)
+    medication_codes = fields.List(fields.Str(), required=True, validate=lambda codes: len(codes) > 0)
+
+class DroneWithMedicationBatchResource(Resource):
+
+    '''Defines the class to load many drones with medications in one transaction. Path to access these class /drones/with-medications/batch'''
+
+    entries_schema = LoadEntrySchema(many=True)
+
+    def post(self):
+
+        '''Load every entry onto its drone. The drones, medications and existing associations are read with one query
+        each and the weight limits are checked in memory. In all_or_nothing mode (the default) nothing is saved if any
+        entry fails, in best_effort mode the valid entries are saved and every entry reports its result'''
+
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('entries'), list) or not data['entries']:
+            return {'message': 'A non empty list of entries is required'}, 400
+        if len(data['entries']) > MAX_BULK_ITEMS:
+            return {'message': f'No more than {MAX_BULK_ITEMS} drones can be loaded in one request'}, 400
+        mode = data.get('mode', 'all_or_nothing')
+        if mode not in BATCH_LOAD_MODES:
+            return {'message': f'The mode must be one of {", ".join(sorted(BATCH_LOAD_MODES))}'}, 400
+
+        # Validate the whole list at once, the errors are indexed by the position of the entry
+        try:
+            entries = self.entries_schema.load(data['entries'])
+            errors = {}
+        except ValidationError as e:
+            entries = e.valid_data
+            errors = e.messages
+        valid_entries = [(index, entry) for index, entry in enumerate(entries) if index not in errors]
+
+        drones = {drone.serial_number: drone for drone in select_rows(
+            db.select(Drone.id, Drone.serial_number, Drone.weight_limit, Drone.current_payload_weight)
+            .where(Drone.serial_number.in_({entry['serial_number'] for index, entry in valid_entries})))}
+        medications = {medication.code: medication for medication in select_rows(
+            db.select(Medication.id, Medication.name, Medication.weight, Medication.code)
+            .where(Medication.code.in_({code for index, entry in valid_entries for code in entry['medication_codes']})))}
+        loaded = set(map(tuple, select_rows(
+            db.select(DroneMedication.drone_id, DroneMedication.medication_id)
+            .where(DroneMedication.drone_id.in_([drone.id for drone in drones.values()]),
+                   DroneMedication.medication_id.in_([medication.id for medication in medications.values()])))))
+
+        # Check the entries in order, an entry sees the medications and weight of the entries accepted before it
+        added_weights = {}
+        associations = []
+        entry_associations = {}
+        results = []
+        for index, entry in enumerate(entries):
+            result = {'index': index, 'serial_number': entry.get('serial_number')}
+            results.append(result)
+            if index in errors:
+                result.update(status='invalid', errors=errors[index])
+                continue
+            drone = drones.get(entry['serial_number'])
+            if drone is None:
+                result.update(status='not_found', message='Drone not found with the given serial number')
+                continue
+            # A repeated code is only loaded once
+            codes = list(dict.fromkeys(entry['medication_codes']))
+            non_existing_codes = [code for code in codes if code not in medications]
+            if non_existing_codes:
+                result.update(status='not_found', message=f'The following medication codes do not exist: {", ".join(non_existing_codes)}')
+                continue
+            associated = [medications[code].name for code in codes if (drone.id, medications[code].id) in loaded]
+            if associated:
+                result.update(status='rejected', message=[f'The medication {name} is already associated with the drone'
+                                                          for name in associated])
+                continue
+            # The same sum as the conditional update of the reservation
+            added_weight = added_weights.get(drone.id, 0.0) + sum(medications[code].weight for code in codes)
+            if drone.current_payload_weight + added_weight > drone.weight_limit:
+                result.update(status='rejected', message='Weight of medications exceeds drone limit')
+                continue
+            added_weights[drone.id] = added_weight
+            entry_associations[index] = [(drone.id, medications[code].id) for code in codes]
+            for code in codes:
+                loaded.add((drone.id, medications[code].id))
+                associations.append({'drone_id': drone.id, 'medication_id': medications[code].id})
+            result['status'] = 'loaded'
+
+        failed = sum(result['status'] != 'loaded' for result in results)
+        if mode == 'all_or_nothing' and failed:
+            for result in results:
+                if result['status'] == 'loaded':
+                    result.update(status='skipped', message='Not loaded, another entry of the batch failed')
+            return {'loaded': 0, 'failed': failed, 'results': results}, 400
+        if not associations:
+            return {'loaded': 0, 'failed': failed, 'results': results}, 400
+
+        # Reserve the weight of every drone with one conditional update, the batch is dropped if any drone changed
+        # since it was read
+        table = Drone.__table__
+        reserved = db.session.connection().execute(
+            table.update().where(table.c.id == db.bindparam('load_drone_id'),
+                                 table.c.current_payload_weight + db.bindparam('load_weight') <= table.c.weight_limit)
+            .values(current_payload_weight=table.c.current_payload_weight + db.bindparam('load_weight')),
+            [{'load_drone_id': drone_id, 'load_weight': weight} for drone_id, weight in added_weights.items()])
+        if reserved.rowcount != len(added_weights):
+            db.session.rollback()
+            return {'message': 'The drones changed while loading, send the batch again'}, 409
+        try:
+            db.session.execute(db.insert(DroneMedication), associations)
+            db.session.commit()
+        except IntegrityError:
+            # Another request loaded some of the medications since they were read, nothing is saved and the
+            # entries with those medications fail
+            db.session.rollback()
+            concurrent = set(map(tuple, select_rows(
+                db.select(DroneMedication.drone_id, DroneMedication.medication_id)
+                .where(DroneMedication.drone_id.in_(added_weights),
+                       DroneMedication.medication_id.in_({association['medication_id'] for association in associations})))))
+            for index, pairs in entry_associations.items():
+                if concurrent.intersection(pairs):
+                    results[index].update(status='failed', message='A medication was loaded onto the drone by another request')
+                else:
+                    results[index].update(status='skipped', message='Not loaded because of a concurrent load, send it again')
+            failed = sum(result['status'] != 'skipped' for result in results)
+            return {'loaded': 0, 'failed': failed, 'results': results}, 409
+
+        serial_numbers = {result['serial_number'] for result in results if result['status'] == 'loaded'}
+        lookup_cache.invalidate(*[drone_key(serial_number) for serial_number in serial_numbers])
+        fleet_index.refresh(serial_numbers)
+        return {'loaded': len(results) - failed, 'failed': failed, 'results': results}, 201
+
+# Unloading of the drones after the delivery
+def unload_drones(serial_numbers):
+
+    '''Remove all the medications of the drones with one delete and set their payload weight to 0. Returns the serial
+    numbers of the drones found and the number of medications removed'''
+
+    drones = select_rows(db.select(Drone.id, Drone.serial_number).where(Drone.serial_number.in_(serial_numbers))).all()
+    drone_ids = [drone.id for drone in drones]
+    removed = db.session.execute(db.delete(DroneMedication).where(DroneMedication.drone_id.in_(drone_ids))
+                                 .execution_options(synchronize_session=False)).rowcount
+    db.session.execute(db.update(Drone).where(Drone.id.in_(drone_ids)).values(current_payload_weight=0.0)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    unloaded = [drone.serial_number for drone in drones]
+    lookup_cache.invalidate(*[drone_key(serial_number) for serial_number in unloaded])
+    fleet_index.refresh(unloaded)
+    return unloaded, removed
+
+class DroneUnloadResource(Resource):
+
+    '''Defines the class to unload a drone. Path to access these class /drones/<serial_number>/unload'''
+
+    def post(self, serial_number):
+
+        '''Remove all the medications of the drone'''
+
+        unloaded, removed = unload_drones([serial_number])
+        if not unloaded:
+            return {'message': 'Drone not found'}, 404
+        return {'message': 'Drone unloaded successfully', 'medications_removed': removed}
+
+class DroneBatchUnloadResource(Resource):
+
+    '''Defines the class to unload many drones in one transaction. Path to access these class /drones/unload'''
+
+    def post(self):
+
+        '''Remove all the medications of the drones of {"serial_numbers": [...]}, the serial numbers that do not exist are reported'''
+
+        data = request.get_json()
+        serial_numbers = data.get('serial_numbers') if isinstance(data, dict) else None
+        if not isinstance(serial_numbers, list) or not serial_numbers \
+                or not all(isinstance(serial_number, str) for serial_number in serial_numbers):
+            return {'message': 'A non empty list of serial numbers is required'}, 400
+        if len(serial_numbers) > MAX_BULK_ITEMS:
+            return {'message': f'No more than {MAX_BULK_ITEMS} drones can be unloaded in one request'}, 400
+
+        unloaded, removed = unload_drones(set(serial_numbers))
+        not_found = sorted(set(serial_numbers) - set(unloaded))
+        return {'unloaded': len(unloaded), 'medications_removed': removed, 'not_found': not_found}, 200 if unloaded else 404
+
+# Dispatch planner. It assigns medications to the IDLE drones with enough battery using as few drones as possible.
+# A drone carries at most one unit of each medication, the association of a drone and a medication is unique
+class PlanItemSchema(Schema):
+
+    '''Defines the scheme of a medication of a dispatch plan'''
+
+    code = fields.Str(required=True)
+    quantity = fields.Int(load_default=1, validate=lambda q: 1 <= q <= MAX_PLAN_UNITS)
+
+class DispatchPlanSchema(Schema):
+
+    '''Defines the scheme of a dispatch plan request'''
+
+    medications = fields.List(fields.Nested(PlanItemSchema), required=True, validate=lambda m: len(m) > 0)
+    min_battery = fields.Float(load_default=25.0, validate=lambda b: 0 <= b <= 100)
+    commit = fields.Bool(load_default=False)
+
+# Maximum number of medication units of a dispatch plan
+MAX_PLAN_UNITS = 100000
+# Tolerance of the weight comparisons
+WEIGHT_EPSILON = 1e-9
+
+class CapacityTree:
+
+    '''Max segment tree over the remaining capacity of the drones, stored in an array of doubles. It finds the first
+    drone from a position with room for a weight in O(log n). A capacity of -1 takes a drone out of the search'''
+
+    def __init__(self, capacities):
+        self.size = 1
+        while self.size < max(len(capacities), 1):
+            self.size *= 2
+        self.tree = array('d', [-1.0]) * (2 * self.size)
+        self.tree[self.size:self.size + len(capacities)] = array('d', capacities)
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def __getitem__(self, index):
+        return self.tree[self.size + index]
+
+    def __setitem__(self, index, capacity):
+        node = self.size + index
+        self.tree[node] = capacity
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+    def find_first(self, weight, start=0):
+
+        '''Position of the first drone at or after start with room for the weight, None if there is none'''
+
+        if start >= self.size:
+            return None
+        weight -= WEIGHT_EPSILON
+        node = self.size + start
+        # Climb to the first subtree on the right of start that has room
+        while self.tree[node] < weight:
+            while node & 1:
+                node //= 2
+            if node == 0:
+                return None
+            node += 1
+        # Descend to its leftmost drone with room
+        while node < self.size:
+            node = 2 * node if self.tree[2 * node] >= weight else 2 * node + 1
+        return node - self.size
+
+def place_units(tree, units, weights, contents, order=None):
+
+    '''Put every unit in the first drone of the tree with room for it that does not carry its medication. The units of
+    a medication follow each other in weight order, so the next unit of a medication searches after the drone of the
+    previous one. Returns the position of the drone of every unit, None for the units that do not fit'''
+
+    positions = []
+    previous_medication, start = None, 0
+    for unit in (order if order is not None else range(len(units))):
+        medication_id = units[unit]
+        if medication_id != previous_medication:
+            previous_medication, start = medication_id, 0
+        position = tree.find_first(weights[unit], start)
+        while position is not None and medication_id in contents[position]:
+            position = tree.find_first(weights[unit], position + 1)
+        positions.append(position)
+        if position is not None:
+            tree[position] = tree[position] - weights[unit]
+            contents[position].add(medication_id)
+            start = position + 1
+    return positions
+
+def plan_dispatch(units, weights, capacities, loaded):
+
+    '''Assign the units to the drones minimizing the number of drones used. units has the medication id of every unit
+    and weights its weight, capacities the free weight of every drone and loaded the medication ids it already carries.
+    First fit decreasing over the drones sorted by capacity, then the least loaded drones are emptied into the others
+    while possible. Returns the position of the drone of every unit, None for the units that do not fit'''
+
+    drone_order = sorted(range(len(capacities)), key=lambda drone: -capacities[drone])
+    tree = CapacityTree([capacities[drone] for drone in drone_order])
+    contents = [set(loaded[drone]) for drone in drone_order]
+    # Heaviest first, the units of a medication together
+    unit_order = sorted(range(len(units)), key=lambda unit: (-weights[unit], units[unit]))
+    positions = [None] * len(units)
+    for unit, position in zip(unit_order, place_units(tree, units, weights, contents, unit_order)):
+        positions[unit] = position
+
+    # Local improvement: try to move all the units of a used drone into the other used drones, the unused drones
+    # are out of the search so a move never opens a new drone
+    assigned = {}
+    for unit, position in enumerate(positions):
+        if position is not None:
+            assigned.setdefault(position, []).append(unit)
+    for position in range(len(drone_order)):
+        if position not in assigned:
+            tree[position] = -1.0
+    for position in sorted(assigned, key=lambda position: sum(weights[unit] for unit in assigned[position])):
+        moving = sorted(assigned[position], key=lambda unit: (-weights[unit], units[unit]))
+        free_capacity = tree[position]
+        tree[position] = -1.0
+        targets = place_units(tree, units, weights, contents, moving)
+        if None in targets:
+            # The drone cannot be emptied, undo the moves
+            for unit, target in zip(moving, targets):
+                if target is not None:
+                    tree[target] = tree[target] + weights[unit]
+                    contents[target].discard(units[unit])
+            tree[position] = free_capacity
+            continue
+        for unit, target in zip(moving, targets):
+            positions[unit] = target
+            assigned[target].append(unit)
+        assigned[position] = []
+
+    # The units that did not fit may fit in the drones that were emptied
+    unplaced = [unit for unit in unit_order if positions[unit] is None]
+    if unplaced:
+        for position, drone in enumerate(drone_order):
+            if not assigned.get(position):
+                tree[position] = capacities[drone]
+                contents[position] = set(loaded[drone])
+        for unit, position in zip(unplaced, place_units(tree, units, weights, contents, unplaced)):
+            positions[unit] = position
+    return [drone_order[position] if position is not None else None for position in positions]
+
+class DispatchPlanResource(Resource):
+
+    '''Defines the class to plan the loading of medications onto the available drones. Path to access these class /dispatch/plan'''
+
+    plan_schema = DispatchPlanSchema()
+
+    def post(self):
+
+        '''Assign the medications to the IDLE drones with at least min_battery using as few drones as possible.
+        With commit the plan is saved in a single transaction, only if every medication fits and the drones did not change'''
+
+        try:
+            data = self.plan_schema.load(request.get_json())
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        quantities = {}
+        for item in data['medications']:
+            quantities[item['code']] = quantities.get(item['code'], 0) + item['quantity']
+        if sum(quantities.values()) > MAX_PLAN_UNITS:
+            return {'message': f'No more than {MAX_PLAN_UNITS} medications can be planned in one request'}, 400
+
+        medications = select_rows(db.select(Medication.id, Medication.code, Medication.weight)
+                                  .where(Medication.code.in_(quantities))).all()
+        if len(medications) != len(quantities):
+            non_existing_codes = set(quantities) - set(medication.code for medication in medications)
+            return {'message': f'The following medication codes do not exist: {", ".join(non_existing_codes)}'}, 404
+
+        drones = select_rows(db.select(Drone.id, Drone.serial_number, Drone.weight_limit - Drone.current_payload_weight)
+                             .where(Drone.state == 'IDLE', Drone.battery_capacity >= data['min_battery'])
+                             .order_by(Drone.id)).all()
+        drone_positions = {drone.id: position for position, drone in enumerate(drones)}
+        loaded = [set() for drone in drones]
+        for drone_id, medication_id in select_rows(
+                db.select(DroneMedication.drone_id, DroneMedication.medication_id)
+                .join(Drone, Drone.id == DroneMedication.drone_id)
+                .where(Drone.state == 'IDLE', Drone.battery_capacity >= data['min_battery'],
+                       DroneMedication.medication_id.in_([medication.id for medication in medications]))):
+            loaded[drone_positions[drone_id]].add(medication_id)
+
+        units = array('q')
+        weights = array('d')
+        for medication in medications:
+            units.extend([medication.id] * quantities[medication.code])
+            weights.extend([medication.weight] * quantities[medication.code])
+        positions = plan_dispatch(units, weights, [drone[2] for drone in drones], loaded)
+
+        codes = {medication.id: medication.code for medication in medications}
+        plan = {}
+        unassigned = {}
+        for medication_id, weight, position in zip(units, weights, positions):
+            if position is None:
+                unassigned[codes[medication_id]] = unassigned.get(codes[medication_id], 0) + 1
+                continue
+            drone_plan = plan.setdefault(position, {'serial_number': drones[position].serial_number,
+                                                    'medication_codes': [], 'medication_ids': [], 'weight': 0.0})
+            drone_plan['medication_codes'].append(codes[medication_id])
+            drone_plan['medication_ids'].append(medication_id)
+            drone_plan['weight'] += weight
+
+        response = {'drones_used': len(plan),
+                    'plan': [{'serial_number': drone_plan['serial_number'], 'medication_codes': drone_plan['medication_codes'],
+                              'weight': drone_plan['weight']} for position, drone_plan in sorted(plan.items())],
+                    'unassigned': [{'code': code, 'quantity': quantity} for code, quantity in unassigned.items()],
+                    'committed': False}
+        if not data['commit']:
+            return response
+        if unassigned:
+            return dict(response, message='The medications do not fit in the available drones'), 400
+
+        # Reserve the weight of every drone with a conditional update, the plan is dropped if any drone changed
+        for position, drone_plan in plan.items():
+            reserved = db.session.execute(reserve_payload_update(drones[position].id, drone_plan['weight'])
+                                          .where(Drone.state == 'IDLE', Drone.battery_capacity >= data['min_battery']))
+            if reserved.rowcount == 0:
+                db.session.rollback()
+                return dict(response, message='The available drones changed while planning, plan again'), 409
+        try:
+            db.session.execute(db.insert(DroneMedication),
+                               [{'drone_id': drones[position].id, 'medication_id': medication_id}
+                                for position, drone_plan in plan.items() for medication_id in drone_plan['medication_ids']])
+            db.session.commit()
+        except IntegrityError:
+            # A medication of the plan was loaded onto its drone by another request
+            db.session.rollback()
+            return dict(response, message='The available drones changed while planning, plan again'), 409
+        lookup_cache.invalidate(*[drone_key(drone_plan['serial_number']) for drone_plan in plan.values()])
+        fleet_index.refresh([drone_plan['serial_number'] for drone_plan in plan.values()])
+        response['committed'] = True
+        return response, 201
+
+def loaded_medications_statement(drone_id):
+
+    '''Query of the medications loaded on a drone using the DroneMedication association table'''
+
+    return db.select(Medication.name, Medication.weight, Medication.code, Medication.image) \
+        .join(DroneMedication, Medication.id == DroneMedication.medication_id) \
+        .where(DroneMedication.drone_id == drone_id)
+
+def available_drones_statement():
+
+    '''Query of the drones that are in the "IDLE" state, served by the partial index ix_drone_idle'''
+
+    return export_statement(Drone, DRONE_FIELDS).where(Drone.state == 'IDLE')
 
-        return {'message': 'Drone with medications created successfully'}, 201
-        
 class DroneService(Resource):
 
     '''Defines the class to handle the additional functionality. Path to access these class /drones/service/<string:action>, /drones/service/<string:action>/<string:serial_number>'''
@@ -370,11 +2512,16 @@ class DroneService(Resource):
         '''method that loads the functionality depending on the requested service'''
         
         if action == 'loaded-medications':
-            return self.get_loaded_medications(serial_number)
+            return conditional_get(['drone', 'medication', 'drone_medication'],
+                                   lambda: self.get_loaded_medications(serial_number))
         elif action == 'available-drones':
-            return self.get_available_drones()
+            if FLEET_ARGUMENTS & request.args.keys():
+                return self.get_available_drones()
+            return conditional_get(['drone'], self.get_available_drones)
         elif action == 'battery-level':
             return self.get_battery_level(serial_number)
+        elif action == 'cache-stats':
+            return lookup_cache.stats()
         else:
             return {'message': 'Invalid action'}, 400
 
@@ -387,31 +2534,32 @@ class DroneService(Resource):
         
         if drone:
              # Query the medications loaded on the drone using the DroneMedication association table
-            loaded_medications = db.session.query(Medication.name, Medication.weight, Medication.code, Medication.image). \
-                join(DroneMedication, Medication.id == DroneMedication.medication_id). \
-                filter(DroneMedication.drone_id == drone.id).all()
-
-            # Convertir los resultados a una lista de diccionarios
-            loaded_medications_list = [
-                {'name': medication.name, 'weight': medication.weight, 'code': medication.code, 'image': medication.image}
-                for medication in loaded_medications
-            ]
+            loaded_medications = select_rows(loaded_medications_statement(drone.id)).all()
 
             # Devolver la respuesta JSON
-            return jsonify({'loaded_medications': loaded_medications_list})
+            return {'loaded_medications': map_rows(loaded_medications, MEDICATION_FIELDS)}
         else:
             return {'message': 'Drone not found'}, 404
 
     def get_available_drones(self):
     
-        '''Get the drones available'''
+        '''Get the drones available. With the model, min_battery or min_capacity arguments the drones are filtered
+        by the fleet index without querying the database'''
         
+        if FLEET_ARGUMENTS & request.args.keys():
+            try:
+                model, min_battery, min_capacity = parse_fleet_arguments(request.args)
+            except ValueError as e:
+                return {'message': str(e)}, 400
+            return {'available_drones': fleet_index.query('IDLE', model, min_battery, min_capacity)}
+
         # Query drones that are in the "IDLE" state
-        available_drones = Drone.query.filter_by(state='IDLE').all()
-        
+        statement = available_drones_statement()
+        if wants_ndjson():
+            return stream_rows(statement, DRONE_FIELDS)
+
         # Construct the response
-        drone_list = [{'serial_number': drone.serial_number, 'model': drone.model, 'weight_limit': drone.weight_limit,
-                       'battery_capacity': drone.battery_capacity, 'state': drone.state} for drone in available_drones]
+        drone_list = map_rows(select_rows(statement), DRONE_FIELDS)
 
         return {'available_drones': drone_list}
 
@@ -419,26 +2567,873 @@ class DroneService(Resource):
     
         '''Get the battery of a drone from its serial number'''
         
-        drone = Drone.query.filter_by(serial_number=serial_number).first()
+        drone = load_drone(serial_number)
         if drone:
-            return {'serial_number': drone.serial_number, 'battery_capacity': drone.battery_capacity}
+            return {'serial_number': drone['serial_number'], 'battery_capacity': drone['battery_capacity']}
         else:
             return {'message': 'Drone not found'}, 404
 
 
 
+# Coalescing of the telemetry readings
+class TelemetryBufferFull(Exception):
+
+    '''Raised when the telemetry buffer cannot take more drones until the next flush'''
+
+class TelemetryBuffer:
+
+    '''Keeps the latest telemetry reading of every drone and writes them to the drone table in a single transaction,
+    every flush_interval seconds or as soon as flush_size drones are pending. The flush runs in a background thread
+    started by the first reading. The battery level is always written, the state only if the drone can move to it'''
+
+    def __init__(self, flush_interval=1.0, flush_size=1000, max_pending=100000):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self.accepted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.unmatched_rows = 0
+        self.flush_errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def add(self, readings):
+
+        '''Add readings to the buffer, a reading replaces the pending one of its drone if it is newer.
+        Raises TelemetryBufferFull if the new drones do not fit in the buffer'''
+
+        with self._lock:
+            new_drones = {reading['serial_number'] for reading in readings} - self._pending.keys()
+            if len(self._pending) + len(new_drones) > self.max_pending:
+                self.rejected += len(readings)
+                raise TelemetryBufferFull()
+            for reading in readings:
+                pending = self._pending.get(reading['serial_number'])
+                if pending is not None:
+                    self.coalesced += 1
+                    if pending['ts'] > reading['ts']:
+                        continue
+                self._pending[reading['serial_number']] = reading
+            self.accepted += len(readings)
+            pending_drones = len(self._pending)
+
+        self._start_worker()
+        if pending_drones >= self.flush_size:
+            self._wakeup.set()
+        return pending_drones
+
+    def flush(self):
+
+        '''Write the pending readings to the drone table in one transaction, returns the number of readings written'''
+
+        with self._flush_lock:
+            with self._lock:
+                readings, self._pending = self._pending, {}
+            if not readings:
+                return 0
+
+            started = time.perf_counter()
+            table = Drone.__table__
+            # The same rule as the transitions, checked on the row being updated
+            moves = db.and_(table.c.state == db.bindparam('reading_expected_state'),
+                            db.or_(db.bindparam('reading_state') != 'LOADING', table.c.battery_capacity < 25))
+            statement = table.update().where(table.c.serial_number == db.bindparam('reading_serial_number')) \
+                .values(battery_capacity=db.bindparam('reading_battery_capacity'),
+                        state=db.case((moves, db.bindparam('reading_state')), else_=table.c.state),
+                        version=db.case((moves, table.c.version + 1), else_=table.c.version))
+            try:
+                with app.app_context():
+                    result = db.session.connection().execute(statement, [
+                        {'reading_serial_number': serial_number, 'reading_battery_capacity': reading['battery_capacity'],
+                         'reading_state': reading['state'], 'reading_expected_state': PREVIOUS_STATE[reading['state']]}
+                        for serial_number, reading in readings.items()])
+                    db.session.commit()
+            except Exception:
+                app.logger.exception('The telemetry flush failed, the readings will be written by the next one')
+                with self._lock:
+                    self.flush_errors += 1
+                    # Put the readings back unless a newer one arrived in the meantime
+                    for serial_number, reading in readings.items():
+                        self._pending.setdefault(serial_number, reading)
+                return 0
+
+            lookup_cache.invalidate(*[drone_key(serial_number) for serial_number in readings])
+            fleet_index.apply_readings(readings)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.flushes += 1
+                self.flushed_rows += result.rowcount
+                self.unmatched_rows += len(readings) - result.rowcount
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self.total_flush_ms += elapsed_ms
+            return len(readings)
+
+    def _start_worker(self):
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name='telemetry-flush', daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stats(self):
+
+        '''Backpressure and flush latency metrics of the buffer'''
+
+        with self._lock:
+            return {'pending': len(self._pending), 'max_pending': self.max_pending, 'accepted': self.accepted,
+                    'coalesced': self.coalesced, 'rejected': self.rejected, 'flushes': self.flushes,
+                    'flushed_rows': self.flushed_rows, 'unmatched_rows': self.unmatched_rows,
+                    'flush_errors': self.flush_errors, 'last_flush_ms': self.last_flush_ms,
+                    'max_flush_ms': self.max_flush_ms,
+                    'avg_flush_ms': self.total_flush_ms / self.flushes if self.flushes else 0.0}
+
+telemetry_buffer = TelemetryBuffer(flush_interval=app.config['DRONE_TELEMETRY_FLUSH_INTERVAL'],
+                                   flush_size=app.config['DRONE_TELEMETRY_FLUSH_SIZE'],
+                                   max_pending=app.config['DRONE_TELEMETRY_MAX_PENDING'])
+# The readings still pending are written when the process exits
+atexit.register(telemetry_buffer.flush)
+
+class TelemetryResource(Resource):
+
+    '''Defines the class to receive the telemetry of the drones. Path to access these class /telemetry'''
+
+    telemetry_schema = TelemetrySchema(many=True)
+
+    def get(self):
+
+        '''Obtain the metrics of the telemetry buffer'''
+
+        return telemetry_buffer.stats()
+
+    def post(self):
+
+        '''Receive a list of readings of the battery and state of the drones. They are written to the database by the next flush'''
+
+        data = request.get_json()
+        if not isinstance(data, list) or not data:
+            return {'message': 'A non empty list of readings is required'}, 400
+        if len(data) > MAX_BULK_ITEMS:
+            return {'message': f'No more than {MAX_BULK_ITEMS} readings can be sent in one request'}, 400
+        try:
+            readings = self.telemetry_schema.load(data)
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        received_at = datetime.utcnow()
+        for reading in readings:
+            if reading['ts'] is None:
+                reading['ts'] = received_at
+            elif reading['ts'].tzinfo is not None:
+                reading['ts'] = reading['ts'].astimezone(timezone.utc).replace(tzinfo=None)
+
+        try:
+            pending = telemetry_buffer.add(readings)
+        except TelemetryBufferFull:
+            return {'message': 'The telemetry buffer is full, retry later'}, 503, {'Retry-After': str(math.ceil(telemetry_buffer.flush_interval))}
+        return {'accepted': len(readings), 'pending': pending}, 202
+
+# Medication images. The files are kept in a content addressed store on disk, named by the sha256 of their content, and
+# the image column of a medication only holds the reference, so the images never grow the database or the JSON responses.
+# Pillow resizes them to thumbnails in a pool of background threads, it is installed with the images extra
+IMAGE_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp'}
+IMAGE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'gif': 'GIF', 'webp': 'WEBP'}
+IMAGE_REFERENCE = re.compile(r'^[0-9a-f]{64}\.(png|jpg|gif|webp)$')
+# Seconds an image can be cached by the clients, the content of a reference never changes
+IMAGE_MAX_AGE = 365 * 86400
+
+def image_extension(content):
+
+    '''Extension of the image from its first bytes, None if it is not a PNG, JPEG, GIF or WebP image'''
+
+    if content.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if content.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if content[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+class BlobStore:
+
+    '''Files named by the sha256 of their content, in subdirectories by the first two characters of the name. A file is
+    written to a temporary name and renamed, so a reader never sees a partial file'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, reference, size=None):
+        directory = self.directory if size is None else os.path.join(self.directory, 'thumbnails', str(size))
+        return os.path.join(directory, reference[:2], reference)
+
+    def put(self, content, extension):
+
+        '''Save the content and return its reference, a content already stored is not written again'''
+
+        reference = f'{hashlib.sha256(content).hexdigest()}.{extension}'
+        if not os.path.exists(self.path(reference)):
+            self.write(self.path(reference), lambda blob_file: blob_file.write(content))
+        return reference
+
+    def write(self, path, save):
+
+        '''Write a file with the save function and rename it to the path'''
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(descriptor, 'wb') as blob_file:
+                save(blob_file)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+class ThumbnailWorker:
+
+    '''Pool of threads that resize the new images to the thumbnail sizes, started by the first image.
+    Without Pillow there are no thumbnails'''
+
+    def __init__(self, store, sizes, workers=2):
+        self.store = store
+        self.sizes = sizes
+        self.workers = workers
+        self._executor = None
+        self._jobs = {}
+        # A job finished before its callback is added runs the callback in the thread holding the lock
+        self._lock = threading.RLock()
+
+    def submit(self, reference):
+
+        '''Resize the image in the background, returns the future of the job or None if there are no thumbnails.
+        An image already being resized is not submitted again'''
+
+        if not self.sizes or importlib.util.find_spec('PIL') is None:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnail')
+            job = self._jobs.get(reference)
+            if job is None:
+                job = self._jobs[reference] = self._executor.submit(self.resize, reference)
+                job.add_done_callback(lambda finished_job: self._finish(reference, finished_job))
+            return job
+
+    def _finish(self, reference, job):
+        with self._lock:
+            if self._jobs.get(reference) is job:
+                del self._jobs[reference]
+
+    def resize(self, reference):
+
+        '''Save the missing thumbnails of the image, they keep its aspect ratio and format'''
+
+        from PIL import Image
+
+        image_format = IMAGE_FORMATS[reference.rsplit('.', 1)[1]]
+        try:
+            for size in self.sizes:
+                path = self.store.path(reference, size)
+                if os.path.exists(path):
+                    continue
+                with Image.open(self.store.path(reference)) as image:
+                    image.thumbnail((size, size))
+                    self.store.write(path, lambda thumbnail_file: image.save(thumbnail_file, format=image_format))
+        except Exception:
+            app.logger.exception(f'The thumbnails of the image {reference} could not be created')
+
+image_store = BlobStore(app.config['DRONE_IMAGE_DIR'])
+thumbnail_worker = ThumbnailWorker(image_store, app.config['DRONE_THUMBNAIL_SIZES'], workers=app.config['DRONE_THUMBNAIL_WORKERS'])
+
+def read_body(limit):
+
+    '''Read at most limit bytes of the body of the request'''
+
+    chunks = []
+    remaining = limit
+    while remaining:
+        chunk = request.stream.read(min(remaining, 65536))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+class MedicationImageResource(Resource):
+
+    '''Defines the class to upload the image of a medication. Path to access these class /medications/<code>/image'''
+
+    def put(self, code):
+
+        '''Save the image sent as the request body in the blob store and set its reference on the medication'''
+
+        max_bytes = app.config['DRONE_IMAGE_MAX_BYTES']
+        if request.content_length is not None and request.content_length > max_bytes:
+            return {'message': f'The image can not be larger than {max_bytes} bytes'}, 413
+        if db.session.scalar(db.select(Medication.id).where(Medication.code == code)) is None:
+            return {'message': 'Medication not found'}, 404
+
+        # A body without Content-Length (chunked) is read up to one byte over the limit, never buffered whole
+        content = read_body(max_bytes + 1)
+        if len(content) > max_bytes:
+            return {'message': f'The image can not be larger than {max_bytes} bytes'}, 413
+        extension = image_extension(content)
+        if extension is None:
+            return {'message': 'The image must be a PNG, JPEG, GIF or WebP file sent as the request body'}, 415
+
+        reference = image_store.put(content, extension)
+        db.session.execute(db.update(Medication).where(Medication.code == code).values(image=reference))
+        db.session.commit()
+        lookup_cache.invalidate(medication_key(code))
+        thumbnail_worker.submit(reference)
+        return {'message': 'Image saved successfully', 'image': reference}
+
+class ImageResource(Resource):
+
+    '''Defines the class to send the images of the blob store. Path to access these class /images/<reference>'''
+
+    def get(self, reference):
+
+        '''Send an image, or its thumbnail with the size argument. The image can be cached for a year and the response
+        supports conditional and range requests. A thumbnail not created yet is replaced by the image, without caching'''
+
+        if not IMAGE_REFERENCE.match(reference) or not os.path.exists(image_store.path(reference)):
+            return {'message': 'Image not found'}, 404
+        size = request.args.get('size')
+        if size is not None and (not size.isdigit() or int(size) not in app.config['DRONE_THUMBNAIL_SIZES']):
+            return {'message': f'The size must be one of {", ".join(map(str, app.config["DRONE_THUMBNAIL_SIZES"]))}'}, 400
+
+        path = image_store.path(reference, size)
+        cached = size is None or os.path.exists(path)
+        if not cached:
+            path = image_store.path(reference)
+        response = send_file(path, mimetype=IMAGE_TYPES[reference.rsplit('.', 1)[1]], conditional=True,
+                             etag=f'{reference}-{size}' if cached else False, max_age=IMAGE_MAX_AGE if cached else None)
+        if cached:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+class MetricsResource(Resource):
+
+    '''Defines the class to export the request metrics of the process. Path to access these class /metrics'''
+
+    def get(self):
+
+        '''Request metrics and log pipeline counters in the Prometheus text format'''
+
+        return Response(request_metrics.render() + log_pipeline.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # Add resource paths to the API
 api.add_resource(DroneResource, '/drones', '/drones/<string:serial_number>')
+api.add_resource(DroneBulkResource, '/drones/bulk')
+api.add_resource(DroneTransitionResource, '/drones/<string:serial_number>/transition')
+api.add_resource(DroneUnloadResource, '/drones/<string:serial_number>/unload')
+api.add_resource(DroneBatchUnloadResource, '/drones/unload')
+api.add_resource(BatteryHistoryResource, '/drones/<string:serial_number>/battery-history')
 api.add_resource(MedicationResource, '/medications', '/medications/<string:code>')
 api.add_resource(DroneWithMedicationResource, '/drones/with-medications')
+api.add_resource(DroneWithMedicationBatchResource, '/drones/with-medications/batch')
+api.add_resource(DispatchPlanResource, '/dispatch/plan')
 api.add_resource(DroneService, '/drones/service/<string:action>', '/drones/service/<string:action>/<string:serial_number>')
+api.add_resource(TelemetryResource, '/telemetry')
+api.add_resource(MedicationImageResource, '/medications/<string:code>/image')
+api.add_resource(ImageResource, '/images/<string:reference>')
+api.add_resource(MetricsResource, '/metrics')
+
+# Async ASGI app. It serves the drone, medication, loading and service routes with the same JSON documents as the
+# Flask app, on asyncio and SQLAlchemy's async engine, so a slow client waiting for a response does not hold a thread.
+# starlette, aiosqlite and uvicorn are installed with the asgi extra
+class AsyncRowStream:
+
+    '''Rows of a query that the ASGI app sends as NDJSON'''
+
+    def __init__(self, statement, field_names):
+        self.statement = statement
+        self.field_names = field_names
+
+def response_parts(response):
+
+    '''Split the value returned by a resource method into data, status and headers, like Flask-RESTful does'''
+
+    if not isinstance(response, tuple):
+        return response, 200, {}
+    data, status, headers = response + (None,) * (3 - len(response))
+    return data, status, headers or {}
+
+def request_full_path(request):
+
+    '''Path and arguments of an ASGI request written like the full_path of a Flask request'''
+
+    return f'{request.url.path}?{request.url.query}'
+
+def request_wants_ndjson(request):
+
+    '''Check if the client of an ASGI request asked for a streamed NDJSON response'''
+
+    return wants_ndjson(parse_accept_header(request.headers.get('accept'), MIMEAccept))
+
+async def async_conditional_get(request, session, tables, build_response):
+
+    '''Same as conditional_get for the ASGI app, the ETag of a response is the one the Flask app gives it'''
+
+    versions = (await session.execute(change_sequence_statement(tables))).all()
+    etag = response_etag(request_full_path(request), request_wants_ndjson(request), versions)
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return None, 304, {'ETag': f'"{etag}"'}
+
+    data, status, headers = response_parts(await build_response())
+    if status == 200:
+        headers['ETag'] = f'"{etag}"'
+    return data, status, headers
+
+async def async_load(session, key, statement, field_names):
+
+    '''Get the fields of a row through the lookup cache'''
+
+    async def loader():
+        return map_row((await session.execute(statement)).first(), field_names)
+    return await lookup_cache.aget(key, loader)
+
+async def async_refresh_fleet(session, serial_numbers):
+
+    '''Same as FleetIndex.refresh for the ASGI app'''
+
+    rows = (await session.execute(fleet_statement().where(Drone.serial_number.in_(serial_numbers)))).all()
+    fleet_index.apply(serial_numbers, rows)
+
+class AsyncDroneResource:
+
+    '''DroneResource of the ASGI app. Path /drones/{serial_number}'''
+
+    drone_schema = DroneSchema()
+
+    async def get(self, request, session, serial_number=None):
+        if serial_number:
+            drone = await async_load(session, drone_key(serial_number), drone_statement(serial_number), DRONE_FIELDS)
+            if drone:
+                return drone
+            return {'message': 'Drone not found'}, 404
+        return await async_conditional_get(request, session, ['drone'], lambda: self.get_page(request, session))
+
+    async def get_page(self, request, session):
+        try:
+            limit, cursor, field_names = parse_page_arguments(DRONE_FIELDS, request.query_params)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        if request_wants_ndjson(request):
+            return AsyncRowStream(export_statement(Drone, field_names, cursor), field_names)
+
+        rows = (await session.execute(page_statement(Drone, field_names, limit, cursor))).all()
+        if not rows and cursor is None:
+            return {'message': 'There are no drones in the database'}
+
+        drone_list, next_cursor = build_page(rows, field_names, limit)
+        return {'drones': drone_list, 'next_cursor': next_cursor}
+
+    async def post(self, request, session):
+        try:
+            new_drone = self.drone_schema.load(await request.json())
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        if await session.scalar(db.select(Drone.id).where(Drone.serial_number == new_drone['serial_number'])):
+            return {'message': 'There is already a drone with this serial number'}, 400
+
+        if new_drone.get('state') == 'LOADING' and new_drone['battery_capacity'] >= 25:
+            return {'message': 'Drone cannot be in LOADING state with battery level up 25%'}, 400
+
+        session.add(Drone(**new_drone))
+        await session.commit()
+        await async_refresh_fleet(session, [new_drone['serial_number']])
+        return {'message': 'Drone successfully created'}, 201
+
+    async def put(self, request, session, serial_number):
+        try:
+            updated_data = self.drone_schema.load(await request.json(), partial=True)
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        drone = (await session.execute(db.select(Drone.state, Drone.version, Drone.battery_capacity)
+                                       .where(Drone.serial_number == serial_number))).first()
+        if not drone:
+            return {'message': 'Drone not found'}, 404
+        statement, error = drone_update(serial_number, drone, updated_data)
+        if error:
+            return error
+
+        if statement is not None:
+            updated = await session.execute(statement)
+            await session.commit()
+            if not updated.rowcount:
+                return {'message': 'Drone was modified by another request'}, 409
+        lookup_cache.invalidate(drone_key(serial_number), drone_key(updated_data.get('serial_number', serial_number)))
+        await async_refresh_fleet(session, [serial_number, updated_data.get('serial_number', serial_number)])
+        return {'message': 'Drone updated successfully'}
+
+    async def delete(self, request, session, serial_number):
+        # The database deletes the medications and the battery history of the drone
+        deleted = await session.execute(db.delete(Drone).where(Drone.serial_number == serial_number)
+                                        .execution_options(synchronize_session=False))
+        if deleted.rowcount == 0:
+            return {'message': 'Drone not found'}, 404
+
+        await session.commit()
+        lookup_cache.invalidate(drone_key(serial_number))
+        await async_refresh_fleet(session, [serial_number])
+        return {'message': 'Drone deleted successfully'}
+
+class AsyncMedicationResource:
+
+    '''MedicationResource of the ASGI app. Path /medications/{code}'''
+
+    medication_schema = MedicationSchema()
+
+    async def get(self, request, session, code=None):
+        if code:
+            medication = await async_load(session, medication_key(code), medication_statement(code), MEDICATION_FIELDS)
+            if medication:
+                return medication
+            return {'message': 'Medication not found'}, 404
+        return await async_conditional_get(request, session, ['medication'], lambda: self.get_page(request, session))
+
+    async def get_page(self, request, session):
+        try:
+            limit, cursor, field_names = parse_page_arguments(MEDICATION_FIELDS, request.query_params)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        if request_wants_ndjson(request):
+            return AsyncRowStream(export_statement(Medication, field_names, cursor), field_names)
+
+        rows = (await session.execute(page_statement(Medication, field_names, limit, cursor))).all()
+        if not rows and cursor is None:
+            return {'message': 'There are no medications in the database'}
+
+        medication_list, next_cursor = build_page(rows, field_names, limit)
+        return {'medications': medication_list, 'next_cursor': next_cursor}
+
+    async def post(self, request, session):
+        try:
+            new_medication = self.medication_schema.load(await request.json())
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        if await session.scalar(db.select(Medication.id).where(Medication.code == new_medication['code'])):
+            return {'message': 'There is already a Medication with this code'}, 400
+
+        session.add(Medication(**new_medication))
+        await session.commit()
+        return {'message': 'Medication created successfully'}, 201
+
+    async def put(self, request, session, code):
+        try:
+            updated_data = self.medication_schema.load(await request.json(), partial=True)
+        except ValidationError as e:
+            return {'message': 'Validation error', 'errors': e.messages}, 400
+
+        medication = await session.scalar(db.select(Medication).where(Medication.code == code))
+        if not medication:
+            return {'message': 'Medication not found'}, 404
+
+        if 'weight' in updated_data and updated_data['weight'] != medication.weight:
+            await session.execute(payload_weight_update(medication.id, updated_data['weight'] - medication.weight))
+        for key, value in updated_data.items():
+            setattr(medication, key, value)
+        await session.commit()
+        lookup_cache.invalidate(medication_key(code), medication_key(updated_data.get('code', code)))
+        if 'weight' in updated_data:
+            fleet_index.invalidate()
+        return {'message': 'Medication updated successfully'}
+
+    async def delete(self, request, session, code):
+        medication = (await session.execute(db.select(Medication.id, Medication.weight).where(Medication.code == code))).first()
+        if not medication:
+            return {'message': 'Medication not found'}, 404
+
+        await session.execute(payload_weight_update(medication.id, -medication.weight))
+        await session.execute(db.delete(Medication).where(Medication.id == medication.id)
+                              .execution_options(synchronize_session=False))
+        await session.commit()
+        lookup_cache.invalidate(medication_key(code))
+        fleet_index.invalidate()
+        return {'message': 'Medication deleted successfully'}
+
+class AsyncDroneWithMedicationResource:
+
+    '''DroneWithMedicationResource of the ASGI app. Path /drones/with-medications'''
+
+    async def post(self, request, session):
+        data = await request.json()
+        if not isinstance(data, dict) or not isinstance(data.get('drone'), dict):
+            return {'message': BadRequest.description}, 400
+        serial_number = data['drone'].get('serial_number')
+
+        drone_id = await session.scalar(db.select(Drone.id).where(Drone.serial_number == serial_number))
+        if drone_id is None:
+            return {'message': 'Drone not found with the given serial number'}, 404
+
+        medication_codes = list(dict.fromkeys(data.get('medication_codes', [])))
+        existing_medications = (await session.execute(
+            db.select(Medication.id, Medication.name, Medication.weight, Medication.code)
+            .where(Medication.code.in_(medication_codes)))).all()
+        if len(existing_medications) != len(medication_codes):
+            non_existing_codes = set(medication_codes) - set(med.code for med in existing_medications)
+            return {'message': f'The following medication codes do not exist: {", ".join(non_existing_codes)}'}, 404
+
+        medication_ids = [med.id for med in existing_medications]
+        associated_ids = set(await session.scalars(
+            db.select(DroneMedication.medication_id)
+            .where(DroneMedication.drone_id == drone_id, DroneMedication.medication_id.in_(medication_ids))))
+        massage = [f'The medication {medication.name} is already associated with the drone'
+                   for medication in existing_medications if medication.id in associated_ids]
+        if massage:
+            return {'message': massage}, 400
+
+        reserved = await session.execute(reserve_payload_update(drone_id, sum(med.weight for med in existing_medications)))
+        if reserved.rowcount == 0:
+            await session.rollback()
+            return {'message': 'Weight of medications exceeds drone limit'}, 400
+
+        try:
+            if medication_ids:
+                await session.execute(db.insert(DroneMedication),
+                                      [{'drone_id': drone_id, 'medication_id': medication_id} for medication_id in medication_ids])
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return {'message': 'The medications were loaded onto the drone by another request'}, 409
+        lookup_cache.invalidate(drone_key(serial_number))
+        await async_refresh_fleet(session, [serial_number])
+        return {'message': 'Drone with medications created successfully'}, 201
+
+class AsyncDroneService:
+
+    '''DroneService of the ASGI app. Path /drones/service/{action}/{serial_number}'''
+
+    async def get(self, request, session, action, serial_number=None):
+        if action == 'loaded-medications':
+            return await async_conditional_get(request, session, ['drone', 'medication', 'drone_medication'],
+                                               lambda: self.get_loaded_medications(session, serial_number))
+        elif action == 'available-drones':
+            if FLEET_ARGUMENTS & request.query_params.keys():
+                return await self.get_available_drones(request, session)
+            return await async_conditional_get(request, session, ['drone'], lambda: self.get_available_drones(request, session))
+        elif action == 'battery-level':
+            drone = await async_load(session, drone_key(serial_number), drone_statement(serial_number), DRONE_FIELDS)
+            if drone:
+                return {'serial_number': drone['serial_number'], 'battery_capacity': drone['battery_capacity']}
+            return {'message': 'Drone not found'}, 404
+        elif action == 'cache-stats':
+            return lookup_cache.stats()
+        else:
+            return {'message': 'Invalid action'}, 400
+
+    async def get_loaded_medications(self, session, serial_number):
+        drone_id = await session.scalar(db.select(Drone.id).where(Drone.serial_number == serial_number))
+        if drone_id is None:
+            return {'message': 'Drone not found'}, 404
+        rows = (await session.execute(loaded_medications_statement(drone_id))).all()
+        return {'loaded_medications': map_rows(rows, MEDICATION_FIELDS)}
+
+    async def get_available_drones(self, request, session):
+        if FLEET_ARGUMENTS & request.query_params.keys():
+            try:
+                model, min_battery, min_capacity = parse_fleet_arguments(request.query_params)
+            except ValueError as e:
+                return {'message': str(e)}, 400
+            # A stale index is reloaded from the database, out of the event loop
+            return {'available_drones': await asyncio.to_thread(fleet_index.query, 'IDLE', model, min_battery, min_capacity)}
+        statement = available_drones_statement()
+        if request_wants_ndjson(request):
+            return AsyncRowStream(statement, DRONE_FIELDS)
+        return {'available_drones': map_rows(await session.execute(statement), DRONE_FIELDS)}
+
+# Routes of the ASGI app, the same paths as the Flask app
+ASGI_ROUTES = [
+    ('/drones', AsyncDroneResource),
+    ('/drones/with-medications', AsyncDroneWithMedicationResource),
+    ('/drones/{serial_number}', AsyncDroneResource),
+    ('/medications', AsyncMedicationResource),
+    ('/medications/{code}', AsyncMedicationResource),
+    ('/drones/service/{action}', AsyncDroneService),
+    ('/drones/service/{action}/{serial_number}', AsyncDroneService),
+]
+
+def async_database_uri(database_uri):
+
+    '''URI of the async driver of the database, aiosqlite for SQLite'''
+
+    url = make_url(database_uri)
+    if url.drivername == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    return url
+
+def create_asgi_app(database_uri=None):
+
+    '''Build the ASGI app, by default on the database of the Flask app and with its SQLite profile'''
+
+    from starlette.applications import Starlette
+    from starlette.exceptions import HTTPException
+    from starlette.responses import JSONResponse, Response as ASGIResponse, StreamingResponse
+    from starlette.routing import Route
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    engine_options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if 'pool_size' in engine_options:
+        # aiosqlite opens a new connection per checkout unless a pool is asked for
+        engine_options['poolclass'] = AsyncAdaptedQueuePool
+    engine = create_async_engine(async_database_uri(database_uri or app.config['SQLALCHEMY_DATABASE_URI']), **engine_options)
+    if engine.dialect.name == 'sqlite':
+        configure_sqlite_engine(engine.sync_engine, app.config['DRONE_DB_PROFILE'])
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    class FastJSONResponse(JSONResponse):
+        def render(self, content):
+            if fast_json_enabled():
+                return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+            return super().render(content)
+
+    def stream_response(stream, headers):
+        async def generate():
+            async with sessions() as session:
+                result = await session.stream(stream.statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+                async for rows in result.partitions():
+                    yield ndjson_lines(rows, stream.field_names)
+        return StreamingResponse(generate(), media_type=NDJSON_MIMETYPE, headers=headers)
+
+    def endpoint(resource):
+        async def handle(request):
+            # Starlette adds HEAD to the GET routes, it is answered as GET without the body
+            method = getattr(resource, 'get' if request.method == 'HEAD' else request.method.lower())
+            async with sessions() as session:
+                try:
+                    data, status, headers = response_parts(await method(request, session, **request.path_params))
+                except json.JSONDecodeError:
+                    data, status, headers = {'message': BadRequest.description}, 400, {}
+            if isinstance(data, AsyncRowStream):
+                return stream_response(data, headers)
+            if data is None:
+                return ASGIResponse(status_code=status, headers=headers)
+            return FastJSONResponse(data, status_code=status, headers=headers)
+        return handle
+
+    async def http_error(request, exc):
+        # The same messages as the errors of Flask-RESTful
+        description = {404: NotFound.description, 405: MethodNotAllowed.description}.get(exc.status_code, exc.detail)
+        return FastJSONResponse({'message': description}, status_code=exc.status_code)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(asgi_app):
+        yield
+        await engine.dispose()
+
+    routes = []
+    for path, resource_class in ASGI_ROUTES:
+        methods = [method.upper() for method in ('get', 'post', 'put', 'delete') if hasattr(resource_class, method)]
+        routes.append(Route(path, endpoint(resource_class()), methods=methods))
+    return Starlette(routes=routes, exception_handlers={HTTPException: http_error}, lifespan=lifespan)
+
+def main_async():
+
+    '''Run the ASGI app with uvicorn, on the same address as the Flask development server'''
+
+    import uvicorn
+    with app.app_context():
+        upgrade_database()
+    uvicorn.run(create_asgi_app(), host='127.0.0.1', port=5000)
+
+# Production server. The app is loaded once in the gunicorn master and the workers are forked from it
+def parse_server_arguments(argv=None):
+
+    '''Read the arguments of start_Drone, the defaults come from the environment'''
+
+    parser = argparse.ArgumentParser(prog='start_Drone', description='Run the drone management API')
+    parser.add_argument('--dev', action='store_true', help='Run the Flask development server with the debugger')
+    parser.add_argument('--bind', default=os.environ.get('DRONE_BIND', '127.0.0.1:5000'), help='Address of the server')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('DRONE_WORKERS', os.cpu_count() or 1)),
+                        help='Number of worker processes, by default one per core')
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('DRONE_MAX_REQUESTS', 10000)),
+                        help='Requests served by a worker before it is replaced, 0 to never replace them')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('DRONE_WORKER_TIMEOUT', 30)),
+                        help='Seconds a worker can be silent before it is restarted, and that it has to finish its requests on shutdown')
+    return parser.parse_args(argv)
+
+def reset_connections_after_fork(server, worker):
+
+    '''The workers are forked from the master that loaded the app, they must not use the connections it opened'''
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if read_engine is not None:
+        read_engine.dispose(close=False)
+
+def gunicorn_options(args):
+
+    '''Settings of gunicorn for the arguments of start_Drone'''
+
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'preload_app': True,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'timeout': args.timeout,
+        'graceful_timeout': args.timeout,
+        'post_fork': reset_connections_after_fork,
+    }
+
+def run_production_server(options):
+
+    '''Run the app in gunicorn with the given settings'''
+
+    from gunicorn.app.base import BaseApplication
+
+    class DroneApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    DroneApplication().run()
 
-def main():
+def main(argv=None):
+    args = parse_server_arguments(argv)
     with app.app_context():
-        # Create tables only if they do not exist
-        db.create_all()
+        # Create the tables that do not exist and upgrade the existing ones
+        upgrade_database()
     # Run the API
-    app.run(debug=True)
+    if args.dev:
+        app.run(debug=True)
+    elif importlib.util.find_spec('gunicorn') is None:
+        app.logger.warning('gunicorn is not installed, the API runs in the threaded Flask server')
+        host, port = args.bind.rsplit(':', 1)
+        app.run(host=host, port=int(port), threaded=True)
+    else:
+        run_production_server(gunicorn_options(args))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,2 +1,32 @@
 from .Drone_Management_API import app
-from .Drone_Management_API import main
\ No newline at end of file
+from .Drone_Management_API import db
+from .Drone_Management_API import Drone
+from .Drone_Management_API import Medication
+from .Drone_Management_API import DroneMedication
+from .Drone_Management_API import BatteryAudit
+from .Drone_Management_API import upgrade_database
+from .Drone_Management_API import plan_dispatch
+from .Drone_Management_API import SQLITE_PROFILES
+from .Drone_Management_API import configure_sqlite_engine
+from .Drone_Management_API import lookup_cache
+from .Drone_Management_API import LRUCache
+from .Drone_Management_API import check_battery_levels_and_create_audit_log
+from .Drone_Management_API import save_battery_snapshots
+from .Drone_Management_API import SchedulerLease
+from .Drone_Management_API import LeaderLease
+from .Drone_Management_API import scheduler_main
+from .Drone_Management_API import telemetry_buffer
+from .Drone_Management_API import fleet_index
+from .Drone_Management_API import request_metrics
+from .Drone_Management_API import log_pipeline
+from .Drone_Management_API import LogPipeline
+from .Drone_Management_API import BatchFileHandler
+from .Drone_Management_API import JsonLogFormatter
+from .Drone_Management_API import image_store
+from .Drone_Management_API import thumbnail_worker
+from .Drone_Management_API import create_asgi_app
+from .Drone_Management_API import parse_server_arguments
+from .Drone_Management_API import gunicorn_options
+from .Drone_Management_API import main
+from .Drone_Management_API import main_async
+from .Drone_Management_API import MAX_PAGE_LIMIT
\ No newline at end of file
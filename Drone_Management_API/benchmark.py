@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# The benchmark seeds its own database, it must be set before the API is imported
+directory = tempfile.mkdtemp()
+os.environ['DRONE_DATABASE_URI'] = f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+os.environ['DRONE_IMAGE_DIR'] = os.path.join(directory, 'blobs')
+os.environ['DRONE_LOG_FILE'] = os.path.join(directory, 'register.log')
+
+from Drone_Management_API import app, db, Drone, Medication, DroneMedication, upgrade_database, save_battery_snapshots, \
+    telemetry_buffer
+
+
+# Latency and throughput of every route of the API on a synthetic fleet, with concurrent clients:
+#   python benchmark.py --drones 1000 --medications 10000 --clients 8 --requests 500 --save-baseline baseline.json
+#   python benchmark.py --drones 1000 --medications 10000 --clients 8 --requests 500 --baseline baseline.json
+# The report is printed as JSON, the exit code is 1 if a route is slower than the baseline by more than the tolerance
+
+MODELS = ["Lightweight", "Middleweight", "Cruiserweight", "Heavyweight"]
+SEED_BATCH = 10000
+# Drones of every request of the batch load scenario
+BATCH_LOAD_DRONES = 20
+
+def seed(drones, medications, associations):
+
+    '''Fill the database with drones, medications and associations of every drone with some medications,
+    and one hour of battery audit'''
+
+    rng = random.Random(0)
+    medication_weights = [round(rng.uniform(0.1, 5.0), 2) for _ in range(medications)]
+    with app.app_context():
+        upgrade_database()
+        for start in range(0, medications, SEED_BATCH):
+            db.session.execute(db.insert(Medication), [
+                {'name': f'Medication{number}', 'weight': medication_weights[number], 'code': f'MED_{number}', 'image': f'med{number}.jpg'}
+                for number in range(start, min(start + SEED_BATCH, medications))])
+        for start in range(0, drones, SEED_BATCH):
+            rows = []
+            loads = []
+            for number in range(start, min(start + SEED_BATCH, drones)):
+                loaded = rng.sample(range(medications), min(associations, medications))
+                rows.append({'id': number + 1, 'serial_number': f'DRN{number}', 'model': rng.choice(MODELS), 'weight_limit': 500.0,
+                             'battery_capacity': round(rng.uniform(0, 100), 1), 'state': 'IDLE',
+                             'current_payload_weight': sum(medication_weights[medication] for medication in loaded)})
+                loads.extend({'drone_id': number + 1, 'medication_id': medication + 1} for medication in loaded)
+            db.session.execute(db.insert(Drone), rows)
+            if loads:
+                db.session.execute(db.insert(DroneMedication), loads)
+        db.session.commit()
+        now = datetime.utcnow()
+        for minutes in range(0, 60, 5):
+            save_battery_snapshots(now - timedelta(minutes=minutes))
+
+def png_image(red=0, width=1):
+
+    '''PNG file of an RGB image of one row, different for every red and width'''
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    row = b'\x00' + bytes([red % 256, 0, 0]) * width
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, 1, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row)) + chunk(b'IEND', b''))
+
+# Image of the image scenarios, uploaded to the LOAD_MED medication
+IMAGE_REFERENCE = hashlib.sha256(png_image(width=64)).hexdigest() + '.png'
+
+def registered_routes():
+
+    '''Rule and method of every route registered with api.add_resource. A method of a resource is served on the
+    rules whose arguments are the arguments of the method'''
+
+    routes = set()
+    for rule in app.url_map.iter_rules():
+        view_class = getattr(app.view_functions[rule.endpoint], 'view_class', None)
+        if view_class is None:
+            continue
+        for method in view_class.methods:
+            parameters = inspect.signature(getattr(view_class, method.lower())).parameters
+            required = {name for name, parameter in parameters.items()
+                        if name != 'self' and parameter.default is inspect.Parameter.empty}
+            if required <= set(rule.arguments) <= set(parameters):
+                routes.add((rule.rule, method))
+    return routes
+
+def build_scenarios(drones, medications):
+
+    '''Requests of every route. Each scenario gives the request number n the method, path, body and the expected status codes.
+    The writes use their own drones and medications so every request succeeds'''
+
+    def drone(n):
+        return f'DRN{n * 7919 % drones}'
+
+    def medication(n):
+        return f'MED_{n * 104729 % medications}'
+
+    def new_drone(serial_number, weight_limit=500.0, battery_capacity=80.0, state='IDLE'):
+        return {'serial_number': serial_number, 'model': 'Lightweight', 'weight_limit': weight_limit,
+                'battery_capacity': battery_capacity, 'state': state}
+
+    def new_medication(code):
+        return {'name': 'Benchmark', 'weight': 1.0, 'code': code, 'image': 'benchmark.jpg'}
+
+    return [
+        ('list drones', '/drones', 'GET', lambda n: ('GET', '/drones?limit=100', None, {200})),
+        ('list drones page', '/drones', 'GET', lambda n: ('GET', f'/drones?limit=100&cursor={n * 7919 % drones}&fields=serial_number,state', None, {200})),
+        ('create drone', '/drones', 'POST', lambda n: ('POST', '/drones', new_drone(f'NEW{n}'), {201})),
+        ('get drone', '/drones/<string:serial_number>', 'GET', lambda n: ('GET', f'/drones/{drone(n)}', None, {200})),
+        ('update drone', '/drones/<string:serial_number>', 'PUT', lambda n: ('PUT', f'/drones/{drone(n)}', {'battery_capacity': float(n % 100)}, {200})),
+        ('delete drone', '/drones/<string:serial_number>', 'DELETE', lambda n: ('DELETE', f'/drones/DEL{n}', None, {200})),
+        ('bulk drones', '/drones/bulk', 'POST', lambda n: ('POST', '/drones/bulk', [new_drone(f'BULK{n}-{i}') for i in range(10)], {201})),
+        ('transition drone', '/drones/<string:serial_number>/transition', 'POST',
+         lambda n: ('POST', f'/drones/STATE{n}/transition', {'state': 'LOADING'}, {200})),
+        ('battery history', '/drones/<string:serial_number>/battery-history', 'GET',
+         lambda n: ('GET', f'/drones/{drone(n)}/battery-history', None, {200})),
+        ('list medications', '/medications', 'GET', lambda n: ('GET', '/medications?limit=100', None, {200})),
+        ('create medication', '/medications', 'POST', lambda n: ('POST', '/medications', new_medication(f'NEW_{n}'), {201})),
+        ('get medication', '/medications/<string:code>', 'GET', lambda n: ('GET', f'/medications/{medication(n)}', None, {200})),
+        ('update medication', '/medications/<string:code>', 'PUT', lambda n: ('PUT', f'/medications/{medication(n)}', {'image': f'image{n}.jpg'}, {200})),
+        ('delete medication', '/medications/<string:code>', 'DELETE', lambda n: ('DELETE', f'/medications/DEL_{n}', None, {200})),
+        ('load drone', '/drones/with-medications', 'POST',
+         lambda n: ('POST', '/drones/with-medications', {'drone': {'serial_number': f'LOAD{n}'}, 'medication_codes': ['LOAD_MED']}, {201})),
+        ('load drones batch', '/drones/with-medications/batch', 'POST',
+         lambda n: ('POST', '/drones/with-medications/batch', {'entries': [{'serial_number': f'BATCH{n}-{i}', 'medication_codes': ['LOAD_MED']}
+                                                                           for i in range(BATCH_LOAD_DRONES)]}, {201})),
+        ('dispatch plan', '/dispatch/plan', 'POST',
+         lambda n: ('POST', '/dispatch/plan', {'medications': [{'code': medication(n + i), 'quantity': 2} for i in range(20)]}, {200})),
+        ('available drones', '/drones/service/<string:action>', 'GET', lambda n: ('GET', '/drones/service/available-drones', None, {200})),
+        ('available drones filtered', '/drones/service/<string:action>', 'GET',
+         lambda n: ('GET', f'/drones/service/available-drones?model={MODELS[n % 4]}&min_battery={n % 100}&min_capacity=400', None, {200})),
+        ('cache stats', '/drones/service/<string:action>', 'GET', lambda n: ('GET', '/drones/service/cache-stats', None, {200})),
+        ('loaded medications', '/drones/service/<string:action>/<string:serial_number>', 'GET',
+         lambda n: ('GET', f'/drones/service/loaded-medications/{drone(n)}', None, {200})),
+        ('battery level', '/drones/service/<string:action>/<string:serial_number>', 'GET',
+         lambda n: ('GET', f'/drones/service/battery-level/{drone(n)}', None, {200})),
+        ('unload drone', '/drones/<string:serial_number>/unload', 'POST', lambda n: ('POST', f'/drones/{drone(n)}/unload', None, {200})),
+        ('unload drones batch', '/drones/unload', 'POST',
+         lambda n: ('POST', '/drones/unload', {'serial_numbers': [drone(n * 20 + i) for i in range(20)]}, {200})),
+        ('telemetry stats', '/telemetry', 'GET', lambda n: ('GET', '/telemetry', None, {200})),
+        ('telemetry', '/telemetry', 'POST',
+         lambda n: ('POST', '/telemetry', [{'serial_number': drone(n + i), 'battery_capacity': 50.0, 'state': 'IDLE'} for i in range(50)], {202})),
+        ('upload image', '/medications/<string:code>/image', 'PUT',
+         lambda n: ('PUT', f'/medications/{medication(n)}/image', png_image(n, n // 256 + 1), {200})),
+        ('get image', '/images/<string:reference>', 'GET', lambda n: ('GET', f'/images/{IMAGE_REFERENCE}', None, {200})),
+        ('get thumbnail', '/images/<string:reference>', 'GET', lambda n: ('GET', f'/images/{IMAGE_REFERENCE}?size=128', None, {200})),
+        ('metrics', '/metrics', 'GET', lambda n: ('GET', '/metrics', None, {200})),
+    ]
+
+def prepare_writes(requests):
+
+    '''Create the drones and medications that the write scenarios delete, transition and load'''
+
+    client = app.test_client()
+    fixtures = [{'serial_number': f'{prefix}{n}', 'model': 'Lightweight', 'weight_limit': 500.0,
+                 'battery_capacity': 20.0, 'state': 'IDLE'} for prefix in ('DEL', 'STATE', 'LOAD') for n in range(requests)]
+    fixtures.extend({'serial_number': f'BATCH{n}-{i}', 'model': 'Lightweight', 'weight_limit': 500.0, 'battery_capacity': 20.0,
+                     'state': 'IDLE'} for n in range(requests) for i in range(BATCH_LOAD_DRONES))
+    for start in range(0, len(fixtures), SEED_BATCH):
+        client.post('/drones/bulk', json=fixtures[start:start + SEED_BATCH])
+    client.post('/medications', json={'name': 'Load', 'weight': 1.0, 'code': 'LOAD_MED', 'image': 'load.jpg'})
+    client.put('/medications/LOAD_MED/image', data=png_image(width=64), content_type='image/png')
+    for n in range(requests):
+        client.post('/medications', json={'name': 'Delete', 'weight': 1.0, 'code': f'DEL_{n}', 'image': 'delete.jpg'})
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_scenario(build_request, requests, clients):
+
+    '''Send the requests of a scenario from concurrent clients and return its latency percentiles and throughput'''
+
+    latencies = []
+    errors = []
+    next_request = iter(range(requests))
+    lock = threading.Lock()
+
+    def client_loop():
+        client = app.test_client()
+        while True:
+            with lock:
+                n = next(next_request, None)
+            if n is None:
+                return
+            method, path, body, expected = build_request(n)
+            started = time.perf_counter()
+            if isinstance(body, bytes):
+                response = client.open(path, method=method, data=body, content_type='image/png')
+            else:
+                response = client.open(path, method=method, json=body)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code not in expected:
+                    errors.append(response.status_code)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client_loop) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {'requests': requests, 'errors': len(errors), 'error_statuses': sorted(set(errors)),
+            'throughput': round(requests / elapsed, 1), 'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3), 'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)}
+
+def regressions(report, baseline, tolerance):
+
+    '''Scenarios whose p95 latency or throughput is worse than the baseline by more than the tolerance'''
+
+    found = []
+    for name, result in report['scenarios'].items():
+        reference = baseline['scenarios'].get(name)
+        if reference is None:
+            continue
+        if result['p95_ms'] > reference['p95_ms'] * (1 + tolerance):
+            found.append({'scenario': name, 'metric': 'p95_ms', 'baseline': reference['p95_ms'], 'value': result['p95_ms']})
+        if result['throughput'] < reference['throughput'] * (1 - tolerance):
+            found.append({'scenario': name, 'metric': 'throughput', 'baseline': reference['throughput'], 'value': result['throughput']})
+        if result['errors'] > reference['errors']:
+            found.append({'scenario': name, 'metric': 'errors', 'baseline': reference['errors'], 'value': result['errors']})
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and throughput of every route of the API on a synthetic fleet')
+    parser.add_argument('--drones', type=int, default=1000)
+    parser.add_argument('--medications', type=int, default=10000)
+    parser.add_argument('--associations', type=int, default=5, help='Medications loaded on every drone')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=500, help='Requests of every scenario')
+    parser.add_argument('--only', help='Comma separated names of the scenarios to run')
+    parser.add_argument('--baseline', help='Report of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Fraction a metric can be worse than the baseline')
+    parser.add_argument('--save-baseline', help='Save the report of this run as a baseline')
+    parser.add_argument('--output', help='File to write the report to, it is printed by default')
+    try:
+        args = parser.parse_args()
+
+        scenarios = build_scenarios(args.drones, args.medications)
+        missing = registered_routes() - {(rule, method) for name, rule, method, build_request in scenarios}
+        if missing:
+            sys.exit(f'Routes without a benchmark scenario: {sorted(missing)}')
+
+        started = time.perf_counter()
+        seed(args.drones, args.medications, args.associations)
+        prepare_writes(args.requests)
+        seed_seconds = time.perf_counter() - started
+
+        selected = set(args.only.split(',')) if args.only else None
+        report = {'config': {'drones': args.drones, 'medications': args.medications, 'associations': args.associations,
+                             'clients': args.clients, 'requests': args.requests, 'profile': app.config['DRONE_DB_PROFILE']},
+                  'seed_seconds': round(seed_seconds, 2), 'scenarios': {}}
+        for name, rule, method, build_request in scenarios:
+            if selected is None or name in selected:
+                report['scenarios'][name] = run_scenario(build_request, args.requests, args.clients)
+        # Maximum resident set size of the process, in kilobytes on Linux
+        report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                report['regressions'] = regressions(report, json.load(baseline_file), args.tolerance)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as baseline_file:
+                json.dump(report, baseline_file, indent=2)
+
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                output_file.write(output)
+        else:
+            print(output)
+    finally:
+        # The pending telemetry is written before the database is removed, also when the run stops early
+        telemetry_buffer.flush()
+        shutil.rmtree(directory)
+    if report.get('regressions'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from Drone_Management_API import SQLITE_PROFILES, configure_sqlite_engine
+
+
+# Mixed load of the API queries against a copy of the database for every SQLite profile:
+#   python load_test.py --readers 8 --writers 2 --seconds 10
+
+READ_QUERY = text("SELECT serial_number, model, weight_limit, battery_capacity, state FROM drone WHERE state = 'IDLE' ORDER BY id LIMIT 100")
+WRITE_QUERY = text('UPDATE drone SET battery_capacity = :battery_capacity WHERE id = :id')
+
+def seed(path, drones):
+
+    '''Create a database with the drone table and the given number of drones'''
+
+    engine = create_engine(f'sqlite:///{path}')
+    with engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE drone (id INTEGER PRIMARY KEY, serial_number VARCHAR(100) UNIQUE NOT NULL, '
+                                   'model VARCHAR(20) NOT NULL, weight_limit FLOAT NOT NULL, battery_capacity FLOAT NOT NULL, '
+                                   'state VARCHAR(20) NOT NULL)')
+        connection.execute(text('INSERT INTO drone (serial_number, model, weight_limit, battery_capacity, state) '
+                                'VALUES (:serial_number, :model, :weight_limit, :battery_capacity, :state)'),
+                           [{'serial_number': f'DRN{i}', 'model': 'Lightweight', 'weight_limit': 500.0,
+                             'battery_capacity': 100.0, 'state': 'IDLE'} for i in range(drones)])
+    engine.dispose()
+
+def run_profile(profile, read_only, drones, readers, writers, seconds):
+
+    '''Run the readers and the writers for the given seconds and return the operations per second and the errors'''
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'load.db')
+    seed(path, drones)
+    options = SQLITE_PROFILES[profile]['engine_options']
+    write_engine = create_engine(f'sqlite:///{path}', **options)
+    configure_sqlite_engine(write_engine, profile)
+    write_engine.connect().close()
+    read_engine = write_engine
+    if read_only:
+        read_engine = create_engine(f'sqlite:///file:{path}?mode=ro&uri=true', **options)
+        configure_sqlite_engine(read_engine, profile, read_only=True)
+
+    counts = {'reads': 0, 'writes': 0, 'read_errors': 0, 'write_errors': 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker(engine, statement, kind):
+        done = errors = 0
+        while not stop.is_set():
+            try:
+                with engine.begin() as connection:
+                    if kind == 'writes':
+                        connection.execute(statement, {'battery_capacity': random.uniform(25, 100), 'id': random.randint(1, drones)})
+                    else:
+                        connection.execute(statement).fetchall()
+                done += 1
+            except OperationalError:
+                errors += 1
+        with lock:
+            counts[kind] += done
+            counts[kind[:-1] + '_errors'] += errors
+
+    threads = [threading.Thread(target=worker, args=(read_engine, READ_QUERY, 'reads')) for _ in range(readers)]
+    threads += [threading.Thread(target=worker, args=(write_engine, WRITE_QUERY, 'writes')) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    read_engine.dispose()
+    write_engine.dispose()
+    shutil.rmtree(directory)
+    return {'profile': profile, 'read_only': read_only,
+            'reads_per_second': round(counts['reads'] / seconds, 1), 'writes_per_second': round(counts['writes'] / seconds, 1),
+            'read_errors': counts['read_errors'], 'write_errors': counts['write_errors']}
+
+def main():
+    parser = argparse.ArgumentParser(description='Mixed read and write load against every SQLite profile')
+    parser.add_argument('--drones', type=int, default=10000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+    for profile, read_only in (('default', False), ('production', False), ('production', True)):
+        print(json.dumps(run_profile(profile, read_only, args.drones, args.readers, args.writers, args.seconds)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# The benchmark runs on its own database, it must be set before the API is imported
+directory = tempfile.mkdtemp()
+os.environ['DRONE_DATABASE_URI'] = f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+os.environ['DRONE_LOG_FILE'] = os.path.join(directory, 'register.log')
+
+from Drone_Management_API import app, upgrade_database, MAX_PAGE_LIMIT
+
+
+# Requests per second of GET /drones and POST /drones, run it before a change of the serialization and after it:
+#   python serialization_benchmark.py --drones 1000 --seconds 5 --save-baseline before.json
+#   python serialization_benchmark.py --drones 1000 --seconds 5 --baseline before.json
+# DRONE_JSON_ENCODER=json measures the responses encoded with the standard library
+
+def requests_per_second(send, seconds):
+
+    '''Send requests for the given seconds and return how many were answered per second'''
+
+    done = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        send(done)
+        done += 1
+    return round(done / (time.perf_counter() - started), 1)
+
+def run(client, seconds):
+    def get_drones(number):
+        # Every drone is read, following the pages of MAX_PAGE_LIMIT drones
+        url = f'/drones?limit={MAX_PAGE_LIMIT}'
+        while url:
+            response = client.get(url)
+            assert response.status_code == 200
+            next_cursor = response.get_json()['next_cursor']
+            url = next_cursor and f'/drones?limit={MAX_PAGE_LIMIT}&cursor={next_cursor}'
+
+    def post_drone(number):
+        response = client.post('/drones', json={'serial_number': f'NEW{number}', 'model': 'Lightweight', 'weight_limit': 500.0,
+                                                'battery_capacity': 100.0, 'state': 'IDLE'})
+        assert response.status_code == 201
+
+    return {'get_drones_per_second': requests_per_second(get_drones, seconds),
+            'post_drones_per_second': requests_per_second(post_drone, seconds)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Requests per second of the drone list and of the drone creation')
+    parser.add_argument('--drones', type=int, default=1000, help='Drones in the database, all of them are read by every GET')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--baseline', help='Result of a previous run, the speedup of every measure is added')
+    parser.add_argument('--save-baseline', help='Save the result of this run as a baseline')
+    args = parser.parse_args()
+
+    try:
+        with app.app_context():
+            upgrade_database()
+        client = app.test_client()
+        client.post('/drones/bulk', json=[{'serial_number': f'SEED{i}', 'model': 'Lightweight', 'weight_limit': 500.0,
+                                           'battery_capacity': 100.0, 'state': 'IDLE'} for i in range(args.drones)])
+        result = run(client, args.seconds)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(result, baseline_file)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        result['speedup'] = {name: round(value / baseline[name], 2) for name, value in result.items() if baseline.get(name)}
+    print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,27 @@ setup(
         'SQLAlchemy==2.0.23',
         'APScheduler==3.10.4',
     ],
+    extras_require={
+        'asgi': [
+            'starlette>=0.37',
+            'aiosqlite>=0.19',
+            'uvicorn>=0.27',
+        ],
+        'production': [
+            'gunicorn>=21.2',
+        ],
+        'fast': [
+            'orjson>=3.8',
+        ],
+        'images': [
+            'Pillow>=10.0',
+        ],
+    },
     entry_points={
         'console_scripts': [
             'start_Drone = Drone_Management_API:main',
+            'start_Drone_async = Drone_Management_API:main_async',
+            'start_Drone_scheduler = Drone_Management_API:scheduler_main',
         ],
     },
 )